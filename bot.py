@@ -1,19 +1,27 @@
 import logging
-from telegram import Update
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from telegram import Update, MessageEntity
 from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import CallbackQueryHandler
 from urllib.parse import quote, unquote
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
+import psycopg2.errors
 import os
-from flask import Flask
+from flask import Flask, jsonify
 import random
 import threading
 import time
 from datetime import datetime, timedelta
 import re
 import unicodedata
+import copy
+import itertools
+import bisect
+from collections import OrderedDict
 
 def normalizar(texto):
     texto = texto.lower()
@@ -24,6 +32,21 @@ def normalizar(texto):
 # ================== CONFIGURAÇÕES ==================
 TOKEN = os.getenv("BOT_TOKEN")
 DATABASE_URL = os.getenv("NEON_DATABASE_URL")
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_IDLE = int(os.getenv("DB_POOL_IDLE", "300"))   # segundos até reciclar conexão ociosa
+DB_POOL_CHECK = int(os.getenv("DB_POOL_CHECK", "30"))  # ociosa há mais que isso → testa com SELECT 1
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))  # segundos esperando conexão livre antes de desistir
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "16"))
+PLAYER_CACHE_MAX = int(os.getenv("PLAYER_CACHE_MAX", "500"))
+USERNAME_FLUSH = int(os.getenv("USERNAME_FLUSH", "30"))  # segundos entre gravações de usernames
+USERNAME_CACHE_MAX = int(os.getenv("USERNAME_CACHE_MAX", "2000"))
+RENDER_CACHE_MAX = int(os.getenv("RENDER_CACHE_MAX", "500"))
+TURNOS_SEMANAS = int(os.getenv("TURNOS_SEMANAS", "8"))  # semanas de turnos guardadas além da atual
+TAREFA_RETRY = int(os.getenv("TAREFA_RETRY", "600"))     # segundos até repetir uma tarefa semanal que falhou
+ITENS_POR_PAGINA = 15
+SUGESTOES_MAX = 3
+REROLLS_DIARIOS = 3
 
 ADMIN_IDS = {int(x) for x in os.getenv("ADMINS", "").split(",") if x.strip().isdigit()}
 PESO_MAX = {1: 5.0, 2: 10.0, 3: 15.0, 4: 20.0, 5: 25.0, 6: 30.0}
@@ -32,6 +55,8 @@ COOLDOWN = 1
 
 MAX_ATRIBUTOS = 20
 MAX_PERICIAS = 40
+# A ordem destas listas é a ordem dos arrays players.atributos/players.pericias no banco:
+# só acrescente nomes no fim (o init_db completa com 0 os arrays dos jogadores existentes).
 ATRIBUTOS_LISTA = ["Força","Destreza","Constituição","Inteligência","Sabedoria","Carisma"]
 PERICIAS_LISTA = ["Percepção","Persuasão","Medicina","Furtividade","Intimidação","Investigação",
                   "Pontaria","Luta","Sobrevivência","Cultura","Intuição","Tecnologia"]
@@ -42,6 +67,7 @@ EDIT_PENDING = {}
 EDIT_TIMERS = {}  # Para timeouts de edição
 
 TRANSFER_PENDING = {}
+SUGESTOES_PENDENTES = {}
 ABANDON_PENDING = {}
 
 KIT_BONUS = {
@@ -77,8 +103,151 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # ================== POSTGRESQL ==================
+class PooledConn:
+    """Conexão emprestada do pool: close() devolve ao pool em vez de encerrar o socket."""
+
+    def __init__(self, pool, raw):
+        self._pool = pool
+        self._raw = raw
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def close(self):
+        raw, self._raw = self._raw, None
+        if raw is not None:
+            self._pool.release(raw)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __del__(self):
+        # Última rede de segurança: os helpers devolvem a conexão em finally
+        self.close()
+
+class ConnPool:
+    """Pool de conexões com tamanho mínimo/máximo, health check e reciclagem de ociosas."""
+
+    def __init__(self, dsn, minconn, maxconn, max_idle, check_after, timeout):
+        self.dsn = dsn
+        self.minconn = minconn
+        self.max_idle = max_idle
+        self.check_after = check_after
+        self.timeout = timeout
+        self._idle = []  # (conexão, último uso)
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(maxconn)
+
+    def _connect(self):
+        return psycopg2.connect(self.dsn, cursor_factory=psycopg2.extras.DictCursor)
+
+    @staticmethod
+    def _discard(conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    @staticmethod
+    def _alive(conn):
+        try:
+            with conn.cursor() as c:
+                c.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def prefill(self):
+        with self._lock:
+            faltam = self.minconn - len(self._idle)
+        for _ in range(max(0, faltam)):
+            conn = self._connect()
+            with self._lock:
+                self._idle.append((conn, time.time()))
+
+    def acquire(self):
+        # Sem vaga depois de `timeout`: alguma conexão não foi devolvida; melhor um erro no log
+        # do que todos os workers do executor parados para sempre
+        if not self._slots.acquire(timeout=self.timeout):
+            raise psycopg2.pool.PoolError(f"Nenhuma conexão livre no pool após {self.timeout}s")
+        try:
+            while True:
+                with self._lock:
+                    item = self._idle.pop() if self._idle else None
+                if item is None:
+                    return self._connect()
+                conn, last_used = item
+                idle = time.time() - last_used
+                if conn.closed or idle > self.max_idle:
+                    self._discard(conn)
+                    continue
+                if idle > self.check_after and not self._alive(conn):
+                    self._discard(conn)
+                    continue
+                return conn
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, conn):
+        try:
+            if not conn.closed and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()  # nunca devolve transação pendente ao pool
+        except psycopg2.Error:
+            self._discard(conn)
+        if not conn.closed:
+            with self._lock:
+                self._idle.append((conn, time.time()))
+        self._slots.release()
+
+DB_POOL = ConnPool(DATABASE_URL, DB_POOL_MIN, DB_POOL_MAX, DB_POOL_IDLE, DB_POOL_CHECK, DB_POOL_TIMEOUT)
+
 def get_conn():
-    return psycopg2.connect(DATABASE_URL, cursor_factory=psycopg2.extras.DictCursor)
+    return PooledConn(DB_POOL, DB_POOL.acquire())
+
+# ================== ACESSO ASSÍNCRONO ==================
+# Um worker por conexão do pool: as chamadas excedentes esperam na fila do executor,
+# nunca no event loop.
+DB_EXECUTOR = ThreadPoolExecutor(max_workers=DB_POOL_MAX, thread_name_prefix="db")
+DB_STATS = {"chamadas": 0, "erros": 0, "na_fila": 0, "em_execucao": 0, "fila_max": 0, "espera_total": 0.0}
+DB_STATS_LOCK = threading.Lock()
+
+async def db(func, *args, **kwargs):
+    """Executa um helper síncrono de banco no executor, sem travar o event loop."""
+    enfileirado = time.monotonic()
+    with DB_STATS_LOCK:
+        DB_STATS["na_fila"] += 1
+        DB_STATS["fila_max"] = max(DB_STATS["fila_max"], DB_STATS["na_fila"])
+
+    def tarefa():
+        inicio = time.monotonic()
+        with DB_STATS_LOCK:
+            DB_STATS["na_fila"] -= 1
+            DB_STATS["em_execucao"] += 1
+            DB_STATS["espera_total"] += inicio - enfileirado
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            with DB_STATS_LOCK:
+                DB_STATS["erros"] += 1
+            raise
+        finally:
+            with DB_STATS_LOCK:
+                DB_STATS["em_execucao"] -= 1
+                DB_STATS["chamadas"] += 1
+
+    return await asyncio.get_running_loop().run_in_executor(DB_EXECUTOR, tarefa)
+
+def db_stats():
+    with DB_STATS_LOCK:
+        stats = dict(DB_STATS)
+    stats["espera_media_ms"] = round(1000 * stats.pop("espera_total") / max(1, stats["chamadas"]), 2)
+    stats["conexoes_ociosas"] = len(DB_POOL._idle)
+    return stats
 
 def init_db():
     conn = get_conn()
@@ -139,13 +308,28 @@ def init_db():
                     caracteres INTEGER,
                     mencoes TEXT,
                     PRIMARY KEY (player_id, data)
-                )''')
+                ) PARTITION BY RANGE (data)''')
     c.execute('''CREATE TABLE IF NOT EXISTS xp_semana (
                     player_id BIGINT,
                     semana_inicio DATE,
                     xp_total INTEGER DEFAULT 0,
                     streak_atual INTEGER DEFAULT 0,
                     PRIMARY KEY (player_id, semana_inicio)
+                ) PARTITION BY RANGE (semana_inicio)''')
+    # Última execução de cada tarefa agendada, para recuperar as perdidas com o bot fora do ar
+    c.execute('''CREATE TABLE IF NOT EXISTS agendador (
+                    tarefa TEXT PRIMARY KEY,
+                    ultima_execucao TIMESTAMP
+                )''')
+    # Ranking final de cada semana encerrada (as partições de xp_semana são descartadas depois)
+    c.execute('''CREATE TABLE IF NOT EXISTS ranking_arquivo (
+                    semana_inicio DATE,
+                    player_id BIGINT,
+                    posicao INTEGER,
+                    nome TEXT,
+                    xp_total INTEGER,
+                    streak INTEGER,
+                    PRIMARY KEY (semana_inicio, player_id)
                 )''')
     c.execute('''CREATE TABLE IF NOT EXISTS interacoes_mutuas (
                     semana_inicio DATE,
@@ -154,49 +338,513 @@ def init_db():
                     PRIMARY KEY (semana_inicio, jogador1, jogador2)
                 )''')
     # ✅ Garante que a tabela catalogo tenha a coluna consumivel
-    try:
-        c.execute("ALTER TABLE catalogo ADD COLUMN consumivel BOOLEAN DEFAULT FALSE;")
-    except psycopg2.errors.DuplicateColumn:
-        conn.rollback()  # ignora erro caso a coluna já exista
+    # (IF NOT EXISTS: um erro aqui desfaria todos os CREATE TABLE acima num banco novo)
+    c.execute("ALTER TABLE catalogo ADD COLUMN IF NOT EXISTS consumivel BOOLEAN DEFAULT FALSE")
+    # Chave de nome normalizada (mesmas regras de normalizar()) para buscas por índice
+    c.execute("ALTER TABLE inventario ADD COLUMN IF NOT EXISTS nome_norm TEXT")
+    c.execute("ALTER TABLE catalogo ADD COLUMN IF NOT EXISTS nome_norm TEXT")
+    for tabela in ("inventario", "catalogo"):
+        c.execute(f"SELECT DISTINCT nome FROM {tabela} WHERE nome_norm IS NULL")
+        pendentes = [(n, normalizar(n)) for (n,) in c.fetchall()]
+        if pendentes:
+            psycopg2.extras.execute_values(c,
+                f"UPDATE {tabela} t SET nome_norm = v.norm FROM (VALUES %s) AS v(nome, norm) WHERE t.nome = v.nome",
+                pendentes)
+    # "Água" e "agua" no mesmo inventário viram uma pilha só antes do índice único
+    c.execute("""SELECT player_id, array_agg(nome ORDER BY nome), SUM(quantidade)
+                 FROM inventario GROUP BY player_id, nome_norm HAVING COUNT(*) > 1""")
+    for pid, nomes, total in c.fetchall():
+        c.execute("UPDATE inventario SET quantidade=%s WHERE player_id=%s AND nome=%s", (total, pid, nomes[0]))
+        c.execute("DELETE FROM inventario WHERE player_id=%s AND nome = ANY(%s)", (pid, nomes[1:]))
+    c.execute("ALTER TABLE inventario ALTER COLUMN nome_norm SET NOT NULL")
+    c.execute("ALTER TABLE catalogo ALTER COLUMN nome_norm SET NOT NULL")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS inventario_nome_norm_key ON inventario(player_id, nome_norm)")
+    # No catálogo, grafias diferentes do mesmo nome são itens cadastrados pelos admins: nada é
+    # apagado sozinho. Se houver conflito, o bot não sobe até alguém escolher qual linha fica.
+    c.execute("""SELECT nome_norm, array_agg(nome ORDER BY nome COLLATE "C") FROM catalogo
+                 GROUP BY nome_norm HAVING COUNT(*) > 1""")
+    conflitos = c.fetchall()
+    if conflitos:
+        for norm, nomes in conflitos:
+            logger.error(f"Catálogo com grafias conflitantes para '{norm}': {', '.join(nomes)}")
+        conn.rollback()
+        conn.close()
+        raise RuntimeError("Nomes duplicados no catálogo (veja o log acima): apague ou renomeie "
+                           "na tabela catalogo as linhas que não devem ficar e reinicie o bot.")
+    c.execute("DROP INDEX IF EXISTS catalogo_nome_norm_idx")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS catalogo_nome_norm_key ON catalogo(nome_norm)")
+    # Pente de cada arma fica na linha do inventário do dono. NULL = arma nunca usada,
+    # que começa com o muni_atual/muni_max do catálogo (agora só um modelo, não mais alterado).
+    c.execute("ALTER TABLE inventario ADD COLUMN IF NOT EXISTS muni_atual INTEGER")
+    c.execute("ALTER TABLE inventario ADD COLUMN IF NOT EXISTS muni_max INTEGER")
+    # /dar confirmado numa ida só: trava os dois jogadores (sempre em ordem de id, para
+    # dois /dar cruzados não travarem um ao outro), move o item e devolve os pesos finais.
+    # Sem a linha de algum dos dois em players, nada é movido ('sem_jogador').
+    # p_peso_catalogo só vem preenchido quando o doador é admin e pode doar do catálogo.
+    c.execute('''CREATE OR REPLACE FUNCTION transferir_item(
+                     p_doador BIGINT, p_alvo BIGINT, p_nome TEXT, p_norm TEXT,
+                     p_qtd INTEGER, p_peso_catalogo REAL)
+                 RETURNS TABLE(status TEXT,
+                               doador_nome TEXT, doador_peso DOUBLE PRECISION, doador_peso_max INTEGER,
+                               alvo_nome TEXT, alvo_peso DOUBLE PRECISION, alvo_peso_max INTEGER) AS $$
+                 DECLARE
+                     v_qtd INTEGER;
+                     v_peso REAL;
+                     v_muni_atual INTEGER;
+                     v_muni_max INTEGER;
+                 BEGIN
+                     PERFORM 1 FROM players p WHERE p.id IN (p_doador, p_alvo) ORDER BY p.id FOR UPDATE;
+                     IF NOT EXISTS (SELECT 1 FROM players p WHERE p.id = p_doador)
+                        OR NOT EXISTS (SELECT 1 FROM players p WHERE p.id = p_alvo) THEN
+                         status := 'sem_jogador';
+                         RETURN NEXT;
+                         RETURN;
+                     END IF;
+                     SELECT i.quantidade, i.peso, i.muni_atual, i.muni_max INTO v_qtd, v_peso, v_muni_atual, v_muni_max
+                       FROM inventario i
+                      WHERE i.player_id = p_doador AND i.nome_norm = p_norm
+                        FOR UPDATE;
+                     IF v_qtd >= p_qtd THEN
+                         IF v_qtd = p_qtd THEN
+                             DELETE FROM inventario i WHERE i.player_id = p_doador AND i.nome_norm = p_norm;
+                         ELSE
+                             UPDATE inventario i SET quantidade = i.quantidade - p_qtd
+                              WHERE i.player_id = p_doador AND i.nome_norm = p_norm;
+                         END IF;
+                     ELSIF p_peso_catalogo IS NOT NULL THEN
+                         v_peso := p_peso_catalogo;
+                     ELSE
+                         status := 'sem_item';
+                         RETURN NEXT;
+                         RETURN;
+                     END IF;
+                     -- Arma entregue leva o pente do doador; quem já tinha a arma mantém o seu
+                     INSERT INTO inventario AS i (player_id, nome, nome_norm, peso, quantidade, muni_atual, muni_max)
+                     VALUES (p_alvo, p_nome, p_norm, v_peso, p_qtd, v_muni_atual, v_muni_max)
+                     ON CONFLICT (player_id, nome_norm) DO UPDATE
+                         SET quantidade = i.quantidade + EXCLUDED.quantidade, peso = EXCLUDED.peso,
+                             muni_atual = COALESCE(i.muni_atual, EXCLUDED.muni_atual),
+                             muni_max = COALESCE(i.muni_max, EXCLUDED.muni_max);
+                     RETURN QUERY
+                         SELECT 'ok'::TEXT,
+                                d.nome, (SELECT COALESCE(SUM(i.peso * i.quantidade), 0)::DOUBLE PRECISION
+                                           FROM inventario i WHERE i.player_id = d.id), d.peso_max,
+                                a.nome, (SELECT COALESCE(SUM(i.peso * i.quantidade), 0)::DOUBLE PRECISION
+                                           FROM inventario i WHERE i.player_id = a.id), a.peso_max
+                           FROM players d, players a
+                          WHERE d.id = p_doador AND a.id = p_alvo;
+                 END $$ LANGUAGE plpgsql''')
+    # Atributos e perícias numa linha só: arrays SMALLINT na ordem de ATRIBUTOS_LISTA/PERICIAS_LISTA.
+    # Jogadores antigos são migrados das tabelas atributos/pericias (mantidas só como histórico).
+    for coluna, lista in (("atributos", ATRIBUTOS_LISTA), ("pericias", PERICIAS_LISTA)):
+        c.execute(f"ALTER TABLE players ADD COLUMN IF NOT EXISTS {coluna} SMALLINT[]")
+        c.execute(f"""UPDATE players p SET {coluna} = ARRAY(
+                          SELECT COALESCE(t.valor, 0)::SMALLINT
+                          FROM unnest(%s::TEXT[]) WITH ORDINALITY AS l(nome, pos)
+                          LEFT JOIN {coluna} t ON t.player_id = p.id AND t.nome = l.nome
+                          ORDER BY l.pos)
+                      WHERE p.{coluna} IS NULL""", (lista,))
+        c.execute(f"ALTER TABLE players ALTER COLUMN {coluna} SET DEFAULT array_fill(0::SMALLINT, ARRAY[{len(lista)}])")
+        c.execute(f"ALTER TABLE players ALTER COLUMN {coluna} SET NOT NULL")
+        # Nomes novos no fim da lista: arrays mais curtos ganham zeros nas posições que faltam
+        c.execute(f"""UPDATE players
+                      SET {coluna} = array_cat({coluna}, array_fill(0::SMALLINT, ARRAY[%s - cardinality({coluna})]))
+                      WHERE cardinality({coluna}) < %s""", (len(lista), len(lista)))
+    # Munição -> armas compatíveis como relação (nomes normalizados), em vez de ler o texto
+    # armas_compat de todo o catálogo a cada /recarregar. A PK começa pela arma: é a busca do comando.
+    c.execute('''CREATE TABLE IF NOT EXISTS municao_compat (
+                    arma_norm TEXT,
+                    municao_norm TEXT,
+                    PRIMARY KEY (arma_norm, municao_norm)
+                )''')
+    c.execute("""SELECT nome_norm, armas_compat FROM catalogo cat
+                 WHERE tipo = 'municao' AND consumivel AND armas_compat <> ''
+                   AND NOT EXISTS (SELECT 1 FROM municao_compat m WHERE m.municao_norm = cat.nome_norm)""")
+    pares = [(arma, mun) for mun, compat in c.fetchall() for arma in armas_compat_norm(compat)]
+    if pares:
+        psycopg2.extras.execute_values(c,
+            "INSERT INTO municao_compat(arma_norm, municao_norm) VALUES %s ON CONFLICT DO NOTHING", pares)
+    # Menções do turno como ids (a coluna texto fica para exibição): a interação mútua do dia
+    # vira uma busca "quem me mencionou" no índice GIN (criado mais abaixo), sem ler e quebrar strings.
+    c.execute("ALTER TABLE turnos ADD COLUMN IF NOT EXISTS mencoes_ids BIGINT[]")
+    c.execute("""UPDATE turnos t SET mencoes_ids = ARRAY(
+                     SELECT DISTINCT u.user_id
+                     FROM unnest(string_to_array(lower(t.mencoes), ',')) AS m(nome)
+                     JOIN usernames u ON u.username = m.nome)
+                 WHERE t.mencoes_ids IS NULL""")
+    c.execute("ALTER TABLE turnos ALTER COLUMN mencoes_ids SET DEFAULT '{}'")
+    c.execute("ALTER TABLE turnos ALTER COLUMN mencoes_ids SET NOT NULL")
+    # XP por tamanho do turno, usado pelo /turno e pelo /xp direto nas consultas
+    c.execute('''CREATE OR REPLACE FUNCTION xp_por_caracteres(n INTEGER) RETURNS INTEGER AS $$
+                     SELECT CASE WHEN n < 500 THEN 0
+                                 WHEN n < 1000 THEN 10
+                                 WHEN n < 1500 THEN 15
+                                 WHEN n < 2000 THEN 20
+                                 ELSE 25 END
+                 $$ LANGUAGE sql IMMUTABLE''')
+    # Rerolls renovados sob demanda: rerolls_dia é o "dia de rerolls" (vira às 06:00) em que o
+    # saldo atual vale; saldo de um dia anterior conta como cheio. Quem já existe fica com o dia de hoje.
+    c.execute("ALTER TABLE players ADD COLUMN IF NOT EXISTS rerolls_dia DATE")
+    c.execute("UPDATE players SET rerolls_dia=%s WHERE rerolls_dia IS NULL", (dia_rerolls(),))
+    c.execute("ALTER TABLE players ALTER COLUMN rerolls_dia SET DEFAULT '-infinity'")
+    c.execute("ALTER TABLE players ALTER COLUMN rerolls_dia SET NOT NULL")
+    # Bancos de antes do particionamento: turnos e xp_semana viram tabelas particionadas por semana
+    particionar_por_semana(c, "turnos", "data")
+    particionar_por_semana(c, "xp_semana", "semana_inicio")
+    garantir_particoes(c, semana_atual())
+    # Interação mútua do /turno: "quem me mencionou hoje" pelo índice GIN
+    c.execute("CREATE INDEX IF NOT EXISTS turnos_mencoes_ids_idx ON turnos USING GIN (mencoes_ids)")
+    # Avisa (LISTEN catalogo) qualquer processo com o catálogo em memória
+    c.execute('''CREATE OR REPLACE FUNCTION notificar_catalogo() RETURNS trigger AS $$
+                 BEGIN
+                     PERFORM pg_notify('catalogo', TG_OP);
+                     RETURN NULL;
+                 END $$ LANGUAGE plpgsql''')
+    c.execute("DROP TRIGGER IF EXISTS catalogo_alterado ON catalogo")
+    c.execute('''CREATE TRIGGER catalogo_alterado
+                 AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON catalogo
+                 FOR EACH STATEMENT EXECUTE FUNCTION notificar_catalogo()''')
     conn.commit()
     conn.close()
 
+# ================== PARTIÇÕES SEMANAIS ==================
+# turnos e xp_semana são particionadas por semana (segunda a domingo, como semana_atual()).
+# As consultas do /turno, /xp e /ranking filtram pela semana e só tocam a partição atual;
+# semanas velhas saem inteiras com DROP da partição, em vez de DELETE linha a linha.
+TABELAS_SEMANAIS = {"turnos": "data", "xp_semana": "semana_inicio"}
+
+def _nome_particao(tabela, semana):
+    return f"{tabela}_s{semana:%Y%m%d}"
+
+def _criar_particao(c, tabela, semana):
+    c.execute(f"CREATE TABLE IF NOT EXISTS {_nome_particao(tabela, semana)} PARTITION OF {tabela} "
+              "FOR VALUES FROM (%s) TO (%s)", (semana, semana + timedelta(days=7)))
+
+def garantir_particoes(c, semana):
+    """Partições da semana dada e da seguinte (a virada de domingo para segunda nunca fica sem partição)."""
+    for tabela in TABELAS_SEMANAIS:
+        _criar_particao(c, tabela, semana)
+        _criar_particao(c, tabela, semana + timedelta(days=7))
+
+def garantir_particoes_atuais():
+    """Cria (se faltarem) as partições da semana atual e da seguinte; roda de hora em hora, então
+    uma falha do fechamento semanal não deixa a segunda-feira sem partição."""
+    conn = get_conn()
+    c = conn.cursor()
+    try:
+        garantir_particoes(c, semana_atual())
+        conn.commit()
+    finally:
+        conn.close()
+
+def particoes(c, tabela):
+    """{semana: nome da partição} das partições semanais existentes."""
+    c.execute("""SELECT f.relname FROM pg_inherits i JOIN pg_class f ON f.oid = i.inhrelid
+                 WHERE i.inhparent = %s::regclass""", (tabela,))
+    res = {}
+    for (nome,) in c.fetchall():
+        try:
+            res[datetime.strptime(nome.rsplit("_s", 1)[1], "%Y%m%d").date()] = nome
+        except (IndexError, ValueError):
+            continue
+    return res
+
+def particionar_por_semana(c, tabela, coluna):
+    """Converte uma tabela comum (banco antigo) na versão particionada, uma partição por semana com dados."""
+    c.execute("SELECT relkind FROM pg_class WHERE oid = %s::regclass", (tabela,))
+    if c.fetchone()[0] == 'p':
+        return
+    legado = f"{tabela}_legado"
+    c.execute(f"ALTER TABLE {tabela} RENAME TO {legado}")
+    c.execute(f"CREATE TABLE {tabela} (LIKE {legado} INCLUDING DEFAULTS) PARTITION BY RANGE ({coluna})")
+    c.execute(f"SELECT DISTINCT date_trunc('week', {coluna})::DATE FROM {legado}")
+    for (semana,) in c.fetchall():
+        _criar_particao(c, tabela, semana)
+    c.execute(f"INSERT INTO {tabela} SELECT * FROM {legado}")
+    # Os índices da tabela antiga vão junto; os nomes ficam livres para a nova
+    c.execute(f"DROP TABLE {legado}")
+    c.execute(f"ALTER TABLE {tabela} ADD PRIMARY KEY (player_id, {coluna})")
+    logger.info(f"📦 {tabela} convertida para partições semanais")
+
+# Ranking final das semanas encerradas que ainda estão em xp_semana
+ARQUIVAR_RANKING_SQL = """
+    INSERT INTO ranking_arquivo (semana_inicio, player_id, posicao, nome, xp_total, streak)
+    SELECT x.semana_inicio, x.player_id,
+           RANK() OVER (PARTITION BY x.semana_inicio ORDER BY x.xp_total DESC),
+           p.nome, x.xp_total, x.streak_atual
+    FROM xp_semana x LEFT JOIN players p ON p.id = x.player_id
+    WHERE x.semana_inicio < %(atual)s
+    ON CONFLICT (semana_inicio, player_id) DO NOTHING
+"""
+
+def fechar_semanas(atual):
+    """Arquiva o ranking das semanas anteriores a `atual`, descarta as partições já arquivadas
+    de xp_semana e as de turnos além de TURNOS_SEMANAS; garante as partições da semana atual."""
+    conn = get_conn()
+    c = conn.cursor()
+    try:
+        garantir_particoes(c, atual)
+        c.execute(ARQUIVAR_RANKING_SQL, {"atual": atual})
+        limites = {"xp_semana": atual, "turnos": atual - timedelta(weeks=TURNOS_SEMANAS)}
+        descartadas = []
+        for tabela, limite in limites.items():
+            for semana, nome in sorted(particoes(c, tabela).items()):
+                if semana < limite:
+                    c.execute(f"DROP TABLE {nome}")
+                    descartadas.append(nome)
+        conn.commit()
+    finally:
+        conn.close()
+    if descartadas:
+        logger.info(f"🗑️ Partições descartadas: {', '.join(descartadas)}")
+
+def get_ranking_arquivo(semana, n=3):
+    """Top n arquivado de uma semana encerrada: [(player_id, nome, xp, streak, posição)]."""
+    conn = get_conn()
+    try:
+        c = conn.cursor()
+        c.execute("""SELECT player_id, nome, xp_total, streak, posicao FROM ranking_arquivo
+                     WHERE semana_inicio=%s ORDER BY posicao, player_id LIMIT %s""", (semana, n))
+        rows = [tuple(r) for r in c.fetchall()]
+    finally:
+        conn.close()
+    return rows
+
+# ================== REGISTRO DE USERNAMES ==================
+# Toda mensagem de texto passa por register_username. Guardamos em memória o último
+# (username, first_name) gravado de cada jogador e só enfileiramos quando algo muda;
+# a fila vai ao banco em lote a cada USERNAME_FLUSH segundos (e no desligamento).
+USERNAMES_GRAVADOS = {}    # user_id -> (username, first_name) como está no banco
+USERNAMES_PENDENTES = {}   # user_id -> (username, first_name, last_seen) a gravar
+USERNAMES_LOCK = threading.Lock()
+USERNAME_IDS = OrderedDict()  # username -> user_id (LRU, até USERNAME_CACHE_MAX)
+
+def _username_id_put(username, user_id):
+    USERNAME_IDS[username] = user_id
+    USERNAME_IDS.move_to_end(username)
+    while len(USERNAME_IDS) > USERNAME_CACHE_MAX:
+        USERNAME_IDS.popitem(last=False)
+
+def _normalizar_tag(user_tag: str) -> str:
+    return (user_tag[1:] if user_tag.startswith('@') else user_tag).lower()
+
+def cached_username_id(user_tag: str) -> int | None:
+    uname = _normalizar_tag(user_tag)
+    with USERNAMES_LOCK:
+        uid = USERNAME_IDS.get(uname)
+        if uid is not None:
+            USERNAME_IDS.move_to_end(uname)
+        return uid
+
+def carregar_usernames():
+    """Preenche o registro com o username mais recente de cada jogador já gravado."""
+    conn = get_conn()
+    try:
+        c = conn.cursor()
+        c.execute("SELECT DISTINCT ON (user_id) user_id, username, first_name FROM usernames ORDER BY user_id, last_seen DESC")
+        rows = c.fetchall()
+    finally:
+        conn.close()
+    with USERNAMES_LOCK:
+        for uid, username, first_name in rows:
+            USERNAMES_GRAVADOS.setdefault(uid, (username, first_name or ''))
+
 def register_username(user_id: int, username: str | None, first_name: str | None):
     if not username:
         return
-    username = username.lower()
-    now = int(time.time())
+    atual = (username.lower(), first_name or '')
+    with USERNAMES_LOCK:
+        pendente = USERNAMES_PENDENTES.get(user_id)
+        if (pendente[:2] if pendente else USERNAMES_GRAVADOS.get(user_id)) == atual:
+            return
+        USERNAMES_PENDENTES[user_id] = atual + (int(time.time()),)
+        _username_id_put(atual[0], user_id)
+
+def flush_usernames():
+    """Grava em lote os usernames alterados desde o último flush."""
+    with USERNAMES_LOCK:
+        if not USERNAMES_PENDENTES:
+            return 0
+        lote = dict(USERNAMES_PENDENTES)
+        USERNAMES_PENDENTES.clear()
+    # Um mesmo username pode ter trocado de dono dentro do lote: vale o mais recente
+    por_username = {}
+    for uid, (username, first_name, visto) in sorted(lote.items(), key=lambda kv: kv[1][2]):
+        por_username[username] = (username, uid, first_name, visto)
     conn = get_conn()
     c = conn.cursor()
-    c.execute("INSERT INTO usernames(username, user_id, first_name, last_seen) VALUES(%s,%s,%s,%s) ON CONFLICT (username) DO UPDATE SET user_id=%s, first_name=%s, last_seen=%s",
-        (username, user_id, first_name or '', now, user_id, first_name or '', now))
-    c.execute("UPDATE players SET username=%s WHERE id=%s", (username, user_id))
-    conn.commit()
-    conn.close()
+    try:
+        psycopg2.extras.execute_values(c,
+            """INSERT INTO usernames(username, user_id, first_name, last_seen) VALUES %s
+               ON CONFLICT (username) DO UPDATE
+               SET user_id=EXCLUDED.user_id, first_name=EXCLUDED.first_name, last_seen=EXCLUDED.last_seen""",
+            list(por_username.values()))
+        psycopg2.extras.execute_values(c,
+            """UPDATE players p SET username = v.username FROM (VALUES %s) AS v(id, username)
+               WHERE p.id = v.id AND p.username IS DISTINCT FROM v.username""",
+            [(uid, username) for uid, (username, _, _) in lote.items()])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        # Devolve à fila o que não foi sobrescrito por uma mensagem mais nova
+        with USERNAMES_LOCK:
+            for uid, item in lote.items():
+                USERNAMES_PENDENTES.setdefault(uid, item)
+        raise
+    finally:
+        conn.close()
+    with USERNAMES_LOCK:
+        for uid, (username, first_name, _) in lote.items():
+            USERNAMES_GRAVADOS[uid] = (username, first_name)
+    for uid, (username, _, _) in lote.items():
+        _cache_update(uid, lambda p, u=username: p.update(username=u))
+    return len(lote)
 
 def username_to_id(user_tag: str) -> int | None:
     if not user_tag:
         return None
-    if user_tag.startswith('@'):
-        uname = user_tag[1:].lower()
-    else:
-        uname = user_tag.lower()
+    uid = cached_username_id(user_tag)
+    if uid is not None:
+        return uid
+    uname = _normalizar_tag(user_tag)
+    # Quem falou há pouco pode ainda não ter ido ao banco
+    with USERNAMES_LOCK:
+        for uid, pendente in USERNAMES_PENDENTES.items():
+            if pendente[0] == uname:
+                return uid
     conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT user_id FROM usernames WHERE username=%s", (uname,))
-    row = c.fetchone()
-    conn.close()
-    return row[0] if row else None
-
-def get_player(uid):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT * FROM players WHERE id=%s", (uid,))
-    row = c.fetchone()
-    if not row:
+    try:
+        c = conn.cursor()
+        c.execute("SELECT user_id FROM usernames WHERE username=%s", (uname,))
+        row = c.fetchone()
+    finally:
         conn.close()
+    if not row:
         return None
-    player = {
+    with USERNAMES_LOCK:
+        _username_id_put(uname, row[0])
+    return row[0]
+
+def ids_em_memoria(usernames):
+    """({username: user_id} achados no cache ou na fila, [usernames que só o banco sabe])."""
+    ids = {}
+    faltando = []
+    for uname in {_normalizar_tag(u) for u in usernames}:
+        uid = cached_username_id(uname)
+        if uid is not None:
+            ids[uname] = uid
+        else:
+            faltando.append(uname)
+    if faltando:
+        with USERNAMES_LOCK:
+            for uid, pendente in USERNAMES_PENDENTES.items():
+                if pendente[0] in faltando:
+                    ids[pendente[0]] = uid
+        faltando = [u for u in faltando if u not in ids]
+    return ids, faltando
+
+def id_por_mencao(message, args) -> tuple[int | None, int]:
+    """Id que o próprio Telegram manda junto da menção (text_mention, para quem não tem @username)
+    quando args começa por ela, e quantas palavras de args a menção ocupa."""
+    if not message or not args:
+        return None, 0
+    for ent, texto in message.parse_entities([MessageEntity.TEXT_MENTION]).items():
+        # context.args quebra o texto da menção nos espaços: compara todas as palavras dela
+        palavras = texto.lower().split()
+        if ent.user and palavras and [a.lower() for a in args[:len(palavras)]] == palavras:
+            register_username(ent.user.id, ent.user.username, ent.user.first_name)
+            return ent.user.id, len(palavras)
+    return None, 0
+
+async def resolver_alvo(message, args):
+    """Alvo no começo de args: entidade da mensagem, depois cache, e só então o banco.
+    Retorna (id ou None, texto da menção, quantas palavras de args ela ocupa)."""
+    uid, n = id_por_mencao(message, args)
+    if uid is not None:
+        return uid, " ".join(args[:n]), n
+    if not args:
+        return None, "", 0
+    user_tag = args[0]
+    uid = cached_username_id(user_tag)
+    if uid is None:
+        uid = await db(username_to_id, user_tag)
+    return uid, user_tag, 1
+
+# ================== CACHE DE JOGADORES ==================
+# LRU de fichas por id. Toda escrita passa por aqui: ou atualiza a entrada (write-through)
+# ou a descarta, e sempre avança a versão do jogador.
+PLAYER_CACHE = OrderedDict()  # id -> (versão, player)
+PLAYER_VERSAO = {}            # id -> versão atual (podada junto com o LRU)
+PLAYER_CACHE_LOCK = threading.Lock()
+_PLAYER_SEQ = itertools.count(1)
+
+def _bump_version(uid):
+    if uid not in PLAYER_VERSAO and len(PLAYER_VERSAO) >= 2 * PLAYER_CACHE_MAX:
+        _podar_versoes()
+    PLAYER_VERSAO[uid] = next(_PLAYER_SEQ)
+    descartar_render("ficha", uid)
+    descartar_render("verficha", uid)
+    return PLAYER_VERSAO[uid]
+
+def _podar_versoes():
+    """Descarta as versões de quem não está no cache (escritas, /ficha de quem nem tem cadastro).
+    A próxima versão vem nova do contador; uma leitura em andamento só deixa de ser guardada."""
+    for fora in [u for u in PLAYER_VERSAO if u not in PLAYER_CACHE]:
+        del PLAYER_VERSAO[fora]
+
+def player_version(uid):
+    with PLAYER_CACHE_LOCK:
+        if uid not in PLAYER_VERSAO:
+            _bump_version(uid)
+        return PLAYER_VERSAO[uid]
+
+def _cache_get(uid):
+    with PLAYER_CACHE_LOCK:
+        entry = PLAYER_CACHE.get(uid)
+        if entry is None or entry[0] != PLAYER_VERSAO.get(uid):
+            return None
+        PLAYER_CACHE.move_to_end(uid)
+        return copy.deepcopy(entry[1])
+
+def _cache_put(uid, player, versao):
+    with PLAYER_CACHE_LOCK:
+        # Uma escrita aconteceu durante a leitura: o que foi lido já está velho
+        if PLAYER_VERSAO.get(uid) != versao:
+            return
+        PLAYER_CACHE[uid] = (versao, copy.deepcopy(player))
+        PLAYER_CACHE.move_to_end(uid)
+        while len(PLAYER_CACHE) > PLAYER_CACHE_MAX:
+            antigo, _ = PLAYER_CACHE.popitem(last=False)
+            PLAYER_VERSAO.pop(antigo, None)
+
+def _cache_update(uid, aplicar):
+    """Write-through: aplica a alteração na ficha em cache (se houver) e avança a versão."""
+    with PLAYER_CACHE_LOCK:
+        versao = _bump_version(uid)
+        entry = PLAYER_CACHE.get(uid)
+        if entry is not None:
+            aplicar(entry[1])
+            PLAYER_CACHE[uid] = (versao, entry[1])
+
+def invalidate_player(*uids):
+    with PLAYER_CACHE_LOCK:
+        for uid in uids:
+            PLAYER_CACHE.pop(uid, None)
+            _bump_version(uid)
+
+# Ficha inteira numa consulta só: atributos e perícias são arrays da própria linha,
+# o inventário vem agregado em JSON
+PLAYER_SQL = """
+    SELECT p.id, p.nome, p.username, p.peso_max, p.hp, p.sp, p.rerolls, p.rerolls_dia, p.atributos, p.pericias,
+           COALESCE((SELECT json_agg(json_build_object('nome', i.nome, 'peso', i.peso, 'quantidade', i.quantidade,
+                                                 'muni_atual', i.muni_atual, 'muni_max', i.muni_max))
+                     FROM inventario i WHERE i.player_id = p.id), '[]') AS inventario
+    FROM players p
+    WHERE p.id = ANY(%s)
+"""
+
+def _player_from_row(row):
+    return {
         "id": row["id"],
         "nome": row["nome"],
         "username": row["username"],
@@ -206,130 +854,399 @@ def get_player(uid):
         "sp": row["sp"],
         "sp_max": 40,   # DEFAULT
         "rerolls": row["rerolls"],
-        "atributos": {},
-        "pericias": {},
-        "inventario": []
+        "rerolls_dia": row["rerolls_dia"],
+        # Posições que o array ainda não tem (nome recém-acrescentado à lista) valem 0
+        "atributos": dict(zip(ATRIBUTOS_LISTA, itertools.chain(row["atributos"], itertools.repeat(0)))),
+        "pericias": dict(zip(PERICIAS_LISTA, itertools.chain(row["pericias"], itertools.repeat(0)))),
+        "inventario": row["inventario"]
     }
-    # Atributos
-    c.execute("SELECT nome, valor FROM atributos WHERE player_id=%s", (uid,))
-    for a, v in c.fetchall():
-        player["atributos"][a] = v
-    # Perícias
-    c.execute("SELECT nome, valor FROM pericias WHERE player_id=%s", (uid,))
-    for a, v in c.fetchall():
-        player["pericias"][a] = v
-    # Inventário
-    c.execute("SELECT nome,peso,quantidade FROM inventario WHERE player_id=%s", (uid,))
-    for n, p, q in c.fetchall():
-        player["inventario"].append({"nome": n, "peso": p, "quantidade": q})
-    conn.close()
-    return player
+
+def get_players(ids):
+    """Carrega várias fichas (cache primeiro, o resto num único SELECT); retorna {id: player} só com quem existe."""
+    players = {}
+    faltando = []
+    for uid in set(ids):
+        player = _cache_get(uid)
+        if player is not None:
+            players[uid] = player
+        else:
+            faltando.append(uid)
+    if not faltando:
+        return players
+    versoes = {uid: player_version(uid) for uid in faltando}
+    conn = get_conn()
+    try:
+        c = conn.cursor()
+        c.execute(PLAYER_SQL, (faltando,))
+        rows = c.fetchall()
+    finally:
+        conn.close()
+    for row in rows:
+        player = _player_from_row(row)
+        _cache_put(player["id"], player, versoes[player["id"]])
+        players[player["id"]] = player
+    return players
+
+def get_player(uid):
+    return get_players([uid]).get(uid)
 
 def create_player(uid, nome, username=None):
     conn = get_conn()
-    c = conn.cursor()
-    c.execute("INSERT INTO players(id,nome,username) VALUES(%s,%s,%s) ON CONFLICT DO NOTHING", (uid, nome, (username or None)))
-    for a in ATRIBUTOS_LISTA:
-        c.execute("INSERT INTO atributos(player_id,nome,valor) VALUES(%s,%s,%s) ON CONFLICT DO NOTHING", (uid, a, 0))
-    for p in PERICIAS_LISTA:
-        c.execute("INSERT INTO pericias(player_id,nome,valor) VALUES(%s,%s,%s) ON CONFLICT DO NOTHING", (uid, p, 0))
-    conn.commit()
-    conn.close()
+    try:
+        c = conn.cursor()
+        # Atributos e perícias nascem zerados pelo DEFAULT das colunas
+        c.execute("INSERT INTO players(id,nome,username) VALUES(%s,%s,%s) ON CONFLICT DO NOTHING", (uid, nome, (username or None)))
+        conn.commit()
+    finally:
+        conn.close()
+    invalidate_player(uid)
 
 def update_player_field(uid, field, value):
     conn = get_conn()
-    c = conn.cursor()
-    c.execute(f"UPDATE players SET {field}=%s WHERE id=%s", (value, uid))
-    conn.commit()
-    conn.close()
+    try:
+        c = conn.cursor()
+        c.execute(f"UPDATE players SET {field}=%s WHERE id=%s", (value, uid))
+        conn.commit()
+    finally:
+        conn.close()
+    _cache_update(uid, lambda p: p.update({field: value}))
+
+# Dano e cura fazem a conta no próprio UPDATE: com updates em paralelo, dois /dano no mesmo
+# alvo não podem ler o mesmo HP e um sobrescrever o outro. O FOR UPDATE devolve o valor
+# anterior já depois de quem estava na frente.
+PONTOS_SQL = {
+    (campo, sentido): f"""
+        UPDATE players p SET {campo} = {limite}
+        FROM (SELECT id, {campo} AS antes FROM players WHERE id = %(uid)s FOR UPDATE) a
+        WHERE p.id = a.id
+        RETURNING a.antes, p.{campo}
+    """
+    for campo in ("hp", "sp")
+    for sentido, limite in (("dano", "GREATEST(0, a.antes - %(valor)s)"), ("cura", "LEAST(40, a.antes + %(valor)s)"))
+}
 
-def update_atributo(uid, nome, valor):
+def ajustar_pontos(uid, campo, sentido, valor):
+    """Aplica dano (piso 0) ou cura (teto 40) em hp/sp; retorna (antes, depois) ou None sem jogador."""
     conn = get_conn()
-    c = conn.cursor()
-    c.execute("UPDATE atributos SET valor=%s WHERE player_id=%s AND nome=%s", (valor, uid, nome))
-    conn.commit()
-    conn.close()
+    try:
+        c = conn.cursor()
+        c.execute(PONTOS_SQL[(campo, sentido)], {"uid": uid, "valor": valor})
+        row = c.fetchone()
+        conn.commit()
+    finally:
+        conn.close()
+    if row is None:
+        return None
+    antes, depois = row
+    _cache_update(uid, lambda p: p.update({campo: depois}))
+    return antes, depois
+
+# Edição de ficha numa instrução só: os valores alterados entram nas posições certas
+# dos arrays (posições sem alteração mantêm o valor atual, as que faltarem viram 0)
+# e o peso_max vem junto.
+FICHA_SALVAR_SQL = """
+    UPDATE players SET
+        atributos = ARRAY(
+            SELECT COALESCE(n.valor, atributos[g.pos], 0)
+            FROM generate_series(1::BIGINT, %(atr_n)s) AS g(pos)
+            LEFT JOIN unnest(%(atr_pos)s::BIGINT[], %(atr_valores)s::SMALLINT[]) AS n(pos, valor) USING (pos)
+            ORDER BY pos),
+        pericias = ARRAY(
+            SELECT COALESCE(n.valor, pericias[g.pos], 0)
+            FROM generate_series(1::BIGINT, %(per_n)s) AS g(pos)
+            LEFT JOIN unnest(%(per_pos)s::BIGINT[], %(per_valores)s::SMALLINT[]) AS n(pos, valor) USING (pos)
+            ORDER BY pos),
+        peso_max = %(peso_max)s
+    WHERE id = %(uid)s
+      AND (cardinality(%(atr_pos)s::BIGINT[]) > 0 OR cardinality(%(per_pos)s::BIGINT[]) > 0
+           OR peso_max IS DISTINCT FROM %(peso_max)s)
+"""
+
+def salvar_ficha(uid, atributos: dict, pericias: dict, forca: int):
+    """Grava só os atributos/perícias alterados e recalcula o peso_max pela Força final."""
+    peso_max = int(PESO_MAX.get(max(1, min(6, int(forca))), 0))
+    conn = get_conn()
+    try:
+        c = conn.cursor()
+        c.execute(FICHA_SALVAR_SQL, {
+            "uid": uid,
+            "atr_n": len(ATRIBUTOS_LISTA), "atr_pos": [ATRIBUTOS_LISTA.index(a) + 1 for a in atributos],
+            "atr_valores": list(atributos.values()),
+            "per_n": len(PERICIAS_LISTA), "per_pos": [PERICIAS_LISTA.index(p) + 1 for p in pericias],
+            "per_valores": list(pericias.values()),
+            "peso_max": peso_max,
+        })
+        conn.commit()
+    finally:
+        conn.close()
+
+    def aplicar(p):
+        p["atributos"].update(atributos)
+        p["pericias"].update(pericias)
+        p["peso_max"] = peso_max
+    _cache_update(uid, aplicar)
+
+# Definir e retirar quantidade de um item: uma ida ao banco, atômica, sem SELECT
+# prévio. O índice único (player_id, nome_norm) serializa cliques concorrentes no
+# mesmo item. (O /dar usa a função transferir_item do banco, com o próprio upsert.)
+INV_DEFINIR_SQL = """
+    INSERT INTO inventario(player_id, nome, nome_norm, peso, quantidade)
+    VALUES (%(uid)s, %(nome)s, %(norm)s, %(peso)s, %(qtd)s)
+    ON CONFLICT (player_id, nome_norm) DO UPDATE
+        SET quantidade = EXCLUDED.quantidade, peso = EXCLUDED.peso
+    RETURNING nome, peso, quantidade
+"""
+
+# Baixa condicional: decrementa se sobrar algo, apaga se zerar, nada se faltar.
+# A linha é travada antes (FOR UPDATE devolve a versão mais recente), então a
+# decisão entre UPDATE e DELETE nunca usa uma quantidade desatualizada.
+INV_RETIRAR_SQL = """
+    WITH alvo AS (
+        SELECT quantidade FROM inventario
+        WHERE player_id = %(uid)s AND nome_norm = %(norm)s
+        FOR UPDATE
+    ), upd AS (
+        UPDATE inventario i SET quantidade = a.quantidade - %(qtd)s
+        FROM alvo a
+        WHERE i.player_id = %(uid)s AND i.nome_norm = %(norm)s AND a.quantidade > %(qtd)s
+        RETURNING i.nome, i.peso, i.quantidade
+    ), del AS (
+        DELETE FROM inventario i
+        USING alvo a
+        WHERE i.player_id = %(uid)s AND i.nome_norm = %(norm)s AND a.quantidade = %(qtd)s
+        RETURNING i.nome, i.peso, 0 AS quantidade
+    )
+    SELECT nome, peso, quantidade FROM upd
+    UNION ALL
+    SELECT nome, peso, quantidade FROM del
+"""
+
+def inv_definir(c, uid, nome, peso, qtd):
+    """Fixa quantidade e peso do item. Retorna (nome, peso, quantidade)."""
+    c.execute(INV_DEFINIR_SQL, {"uid": uid, "nome": nome, "norm": normalizar(nome), "peso": peso, "qtd": qtd})
+    return tuple(c.fetchone())
+
+def inv_retirar(c, uid, nome, qtd):
+    """Retira qtd do item. Retorna (nome, peso, restante) ou None se não houver o bastante."""
+    c.execute(INV_RETIRAR_SQL, {"uid": uid, "norm": normalizar(nome), "qtd": qtd})
+    row = c.fetchone()
+    return tuple(row) if row else None
 
-def update_pericia(uid, nome, valor):
+def _inv_executar(uid, op, *args):
     conn = get_conn()
     c = conn.cursor()
-    c.execute("UPDATE pericias SET valor=%s WHERE player_id=%s AND nome=%s", (valor, uid, nome))
-    conn.commit()
-    conn.close()
+    try:
+        res = op(c, uid, *args)
+        conn.commit()
+    finally:
+        conn.close()
+    invalidate_player(uid)
+    return res
 
 def update_inventario(uid, item):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT quantidade FROM inventario WHERE player_id=%s AND LOWER(nome)=LOWER(%s)", (uid, item['nome']))
-    row = c.fetchone()
-    if row:
-        c.execute("UPDATE inventario SET quantidade=%s, peso=%s WHERE player_id=%s AND LOWER(nome)=LOWER(%s)",
-                  (item['quantidade'], item['peso'], uid, item['nome']))
-    else:
-        c.execute("INSERT INTO inventario(player_id, nome, peso, quantidade) VALUES (%s, %s, %s, %s)",
-                  (uid, item['nome'], item['peso'], item['quantidade']))
-    conn.commit()
-    conn.close()
+    _inv_executar(uid, inv_definir, item['nome'], item['peso'], item['quantidade'])
 
 def adjust_item_quantity(uid, item_nome, delta):
+    """Aplica delta a um item que o jogador já possui. False se não tiver (ou não tiver o bastante)."""
+    if delta < 0:
+        return _inv_executar(uid, inv_retirar, item_nome, -delta) is not None
     conn = get_conn()
     c = conn.cursor()
-    c.execute("SELECT quantidade, peso FROM inventario WHERE player_id=%s AND LOWER(nome)=LOWER(%s)", (uid, item_nome))
-    row = c.fetchone()
-    if not row:
+    try:
+        c.execute("UPDATE inventario SET quantidade = quantidade + %s WHERE player_id=%s AND nome_norm=%s RETURNING quantidade",
+                  (delta, uid, normalizar(item_nome)))
+        ok = c.fetchone() is not None
+        conn.commit()
+    finally:
         conn.close()
-        return False
-    qtd, peso = row
-    nova = qtd + delta
-    if nova <= 0:
-        c.execute("DELETE FROM inventario WHERE player_id=%s AND LOWER(nome)=LOWER(%s)", (uid, item_nome))
-    else:
-        c.execute("UPDATE inventario SET quantidade=%s WHERE player_id=%s AND LOWER(nome)=LOWER(%s)", (nova, uid, item_nome))
-    conn.commit()
-    conn.close()
-    return True
+    invalidate_player(uid)
+    return ok
+
+# ================== BUSCA DE NOMES ==================
+# Busca aproximada de itens pelo nome, com a mesma dobra de normalizar(): primeiro
+# prefixo (busca binária nos nomes ordenados), depois semelhança por trigramas.
+def _trigramas(chave):
+    s = f"  {chave} "
+    return {s[i:i + 3] for i in range(len(s) - 2)}
+
+class NomeIndex:
+    __slots__ = ("_nomes", "_chaves", "_trigramas", "_tamanho")
+
+    def __init__(self, nomes):
+        self._nomes = {}        # nome normalizado -> nome original (o primeiro vence)
+        for nome in nomes:
+            self._nomes.setdefault(normalizar(nome), nome)
+        self._chaves = sorted(self._nomes)
+        self._trigramas = {}    # trigrama -> nomes normalizados que o contêm
+        self._tamanho = {}
+        for chave in self._chaves:
+            tri = _trigramas(chave)
+            self._tamanho[chave] = len(tri)
+            for t in tri:
+                self._trigramas.setdefault(t, []).append(chave)
+
+    def sugerir(self, entrada, limite=SUGESTOES_MAX, filtro=None, minimo=0.3):
+        """Até `limite` nomes originais parecidos com a entrada, do mais provável ao menos."""
+        q = " ".join(normalizar(entrada).split())
+        if not q:
+            return []
+        placar = {}
+        # Prefixo vale mais que qualquer semelhança por trigramas
+        i = bisect.bisect_left(self._chaves, q)
+        while i < len(self._chaves) and self._chaves[i].startswith(q):
+            placar[self._chaves[i]] = 1 + len(q) / len(self._chaves[i])
+            i += 1
+        tq = _trigramas(q)
+        comuns = {}
+        for t in tq:
+            for chave in self._trigramas.get(t, ()):
+                comuns[chave] = comuns.get(chave, 0) + 1
+        for chave, n in comuns.items():
+            dice = 2 * n / (len(tq) + self._tamanho[chave])
+            if dice >= minimo and dice > placar.get(chave, 0):
+                placar[chave] = dice
+        melhores = sorted(placar, key=lambda k: (-placar[k], k))
+        nomes = (self._nomes[k] for k in melhores)
+        if filtro:
+            nomes = (n for n in nomes if filtro(n))
+        return list(itertools.islice(nomes, limite))
+
+def indice_inventario(player):
+    return NomeIndex(i['nome'] for i in player.get("inventario", []))
+
+# ================== CATÁLOGO EM MEMÓRIA ==================
+# O catálogo só muda por /additem, /addarma, /addconsumivel, /delitem (ou SQL manual, que chega
+# via NOTIFY). As leituras usam uma foto imutável, refeita só depois de uma alteração.
+CATALOGO_COLUNAS = ("nome", "peso", "consumivel", "bonus", "tipo", "arma_tipo", "arma_bonus", "muni_atual", "muni_max", "armas_compat")
+
+# Filtros do /itens sobre as linhas do catálogo (na ordem de CATALOGO_COLUNAS)
+FILTROS_CATALOGO = {
+    "todos": ("Todos", lambda r: True),
+    "armas": ("Armas", lambda r: bool(r[5])),
+    "consumiveis": ("Consumíveis", lambda r: bool(r[2]) and r[4] != 'municao'),
+    "municao": ("Munição", lambda r: r[4] == 'municao'),
+}
+
+class CatalogSnapshot:
+    """Foto imutável do catálogo, indexada pelo nome normalizado."""
+    __slots__ = ("versao", "itens", "nomes", "_por_nome", "_ordem")
+
+    def __init__(self, versao, rows):
+        self.versao = versao
+        self.itens = tuple(tuple(r) for r in rows)
+        self._por_nome = {}
+        for r in self.itens:
+            self._por_nome.setdefault(normalizar(r[0]), r)
+        self.nomes = NomeIndex(r[0] for r in self.itens)
+        # Para o /itens: (chaves, linhas) ordenadas por nome normalizado, uma lista por filtro
+        ordenado = sorted(((normalizar(r[0]), r) for r in self.itens), key=lambda kv: (kv[0], kv[1][0]))
+        self._ordem = {}
+        for filtro, (_, aceita) in FILTROS_CATALOGO.items():
+            sel = [kv for kv in ordenado if aceita(kv[1])]
+            self._ordem[filtro] = ([k for k, _ in sel], [r for _, r in sel])
+
+    def get(self, nome):
+        row = self._por_nome.get(normalizar(nome))
+        return dict(zip(CATALOGO_COLUNAS, row)) if row else None
+
+    def pagina(self, filtro, ini=0, n=ITENS_POR_PAGINA):
+        """Página que começa na posição `ini` da lista ordenada do filtro (a foto é imutável,
+        então a posição identifica a página). Retorna (linhas, início, total)."""
+        chaves, rows = self._ordem[filtro]
+        total = len(chaves)
+        ini = max(0, min(ini, total))
+        fim = min(ini + n, total)
+        # Nomes normalizados iguais nunca ficam divididos entre duas páginas
+        while 0 < ini < total and chaves[ini - 1] == chaves[ini]:
+            ini -= 1
+        while 0 < fim < total and chaves[fim - 1] == chaves[fim]:
+            fim += 1
+        return rows[ini:fim], ini, total
+
+_CATALOGO = None
+_CATALOGO_GERACAO = 0
+_CATALOGO_LOCK = threading.Lock()
+_CATALOGO_SEQ = itertools.count(1)
+
+def catalog_snapshot():
+    global _CATALOGO
+    snap = _CATALOGO
+    if snap is not None:
+        return snap
+    with _CATALOGO_LOCK:
+        if _CATALOGO is not None:
+            return _CATALOGO
+        geracao = _CATALOGO_GERACAO
+        conn = get_conn()
+        try:
+            c = conn.cursor()
+            c.execute("SELECT nome,peso,consumivel,bonus,tipo,arma_tipo,arma_bonus,muni_atual,muni_max,armas_compat FROM catalogo ORDER BY nome COLLATE \"C\"")
+            snap = CatalogSnapshot(next(_CATALOGO_SEQ), c.fetchall())
+        finally:
+            conn.close()
+        # Só publica se ninguém alterou o catálogo durante a leitura
+        if geracao == _CATALOGO_GERACAO:
+            _CATALOGO = snap
+        return snap
+
+def invalidate_catalog():
+    global _CATALOGO, _CATALOGO_GERACAO
+    _CATALOGO_GERACAO = next(_CATALOGO_SEQ)
+    _CATALOGO = None
+    descartar_render("itens")
+
+async def catalogo():
+    """Foto atual do catálogo; só vai ao banco (fora do event loop) se ela precisar ser refeita."""
+    snap = _CATALOGO
+    if snap is not None:
+        return snap
+    return await db(catalog_snapshot)
 
 def get_catalog_item(nome: str):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT nome, peso, consumivel, bonus, tipo, arma_tipo, arma_bonus, muni_atual, muni_max, armas_compat FROM catalogo WHERE LOWER(nome)=LOWER(%s)", (nome,))
-    row = c.fetchone()
-    conn.close()
-    if not row:
-        return None
-    return {
-        "nome": row[0], "peso": row[1], "consumivel": row[2], "bonus": row[3], "tipo": row[4],
-        "arma_tipo": row[5], "arma_bonus": row[6], "muni_atual": row[7], "muni_max": row[8], "armas_compat": row[9]
-    }
+    return catalog_snapshot().get(nome)
+
+def armas_compat_norm(armas_compat):
+    """'Pistola, Rifle' -> {'pistola', 'rifle'}"""
+    return {normalizar(x.strip()) for x in (armas_compat or '').split(',') if x.strip()}
 
 def add_catalog_item(nome: str, peso: float, consumivel: bool = False, bonus: int = 0, tipo: str = '', arma_tipo: str = '', arma_bonus: int = 0, muni_atual: int = 0, muni_max: int = 0, armas_compat: str = ''):
     conn = get_conn()
-    c = conn.cursor()
-    c.execute(
-        "INSERT INTO catalogo(nome,peso,consumivel,bonus,tipo,arma_tipo,arma_bonus,muni_atual,muni_max,armas_compat) VALUES(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s) "
-        "ON CONFLICT (nome) DO UPDATE SET peso=%s, consumivel=%s, bonus=%s, tipo=%s, arma_tipo=%s, arma_bonus=%s, muni_atual=%s, muni_max=%s, armas_compat=%s",
-        (nome, peso, consumivel, bonus, tipo, arma_tipo, arma_bonus, muni_atual, muni_max, armas_compat,
-         peso, consumivel, bonus, tipo, arma_tipo, arma_bonus, muni_atual, muni_max, armas_compat)
-    )
-    conn.commit()
-    conn.close()
+    try:
+        c = conn.cursor()
+        c.execute(
+            "INSERT INTO catalogo(nome,nome_norm,peso,consumivel,bonus,tipo,arma_tipo,arma_bonus,muni_atual,muni_max,armas_compat) VALUES(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s) "
+            "ON CONFLICT (nome_norm) DO UPDATE SET nome=%s, peso=%s, consumivel=%s, bonus=%s, tipo=%s, arma_tipo=%s, arma_bonus=%s, muni_atual=%s, muni_max=%s, armas_compat=%s",
+            (nome, normalizar(nome), peso, consumivel, bonus, tipo, arma_tipo, arma_bonus, muni_atual, muni_max, armas_compat,
+             nome, peso, consumivel, bonus, tipo, arma_tipo, arma_bonus, muni_atual, muni_max, armas_compat)
+        )
+        # Compatibilidade refeita junto com o item, na mesma transação
+        mun_norm = normalizar(nome)
+        c.execute("DELETE FROM municao_compat WHERE municao_norm=%s", (mun_norm,))
+        if tipo == 'municao' and consumivel:
+            pares = [(arma, mun_norm) for arma in armas_compat_norm(armas_compat)]
+            if pares:
+                psycopg2.extras.execute_values(c,
+                    "INSERT INTO municao_compat(arma_norm, municao_norm) VALUES %s ON CONFLICT DO NOTHING", pares)
+        conn.commit()
+    finally:
+        conn.close()
+    invalidate_catalog()
 
 def del_catalog_item(nome: str) -> bool:
     conn = get_conn()
-    c = conn.cursor()
-    c.execute("DELETE FROM catalogo WHERE LOWER(nome)=LOWER(%s)", (nome,))
-    deleted = c.rowcount
-    conn.commit()
-    conn.close()
+    try:
+        c = conn.cursor()
+        c.execute("DELETE FROM catalogo WHERE nome_norm=%s", (normalizar(nome),))
+        deleted = c.rowcount
+        c.execute("DELETE FROM municao_compat WHERE municao_norm=%s", (normalizar(nome),))
+        conn.commit()
+    finally:
+        conn.close()
+    invalidate_catalog()
     return deleted > 0
 
 def list_catalog():
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT nome,peso,consumivel,bonus,tipo,arma_tipo,arma_bonus,muni_atual,muni_max,armas_compat FROM catalogo ORDER BY nome COLLATE \"C\"")
-    data = c.fetchall()
-    conn.close()
-    return data
+    return catalog_snapshot().itens
 
 def is_consumivel_catalogo(nome: str):
     item = get_catalog_item(nome)
@@ -337,14 +1254,163 @@ def is_consumivel_catalogo(nome: str):
 
 def remove_item(uid, item_nome):
     conn = get_conn()
+    try:
+        c = conn.cursor()
+        c.execute("DELETE FROM inventario WHERE player_id=%s AND nome_norm=%s", (uid, normalizar(item_nome)))
+        conn.commit()
+    finally:
+        conn.close()
+    invalidate_player(uid)
+
+def municoes_compativeis(uid, arma_nome):
+    """Munições do inventário que servem na arma: [(nome, quantidade)], numa consulta só pelos índices."""
+    conn = get_conn()
+    try:
+        c = conn.cursor()
+        c.execute("""SELECT i.nome, i.quantidade
+                     FROM municao_compat m
+                     JOIN inventario i ON i.player_id = %s AND i.nome_norm = m.municao_norm
+                     WHERE m.arma_norm = %s AND i.quantidade > 0
+                     ORDER BY i.nome""", (uid, normalizar(arma_nome)))
+        rows = [tuple(r) for r in c.fetchall()]
+    finally:
+        conn.close()
+    return rows
+
+def get_inventory_item(uid, item_nome):
+    conn = get_conn()
+    try:
+        c = conn.cursor()
+        c.execute("SELECT nome, peso, quantidade FROM inventario WHERE player_id=%s AND nome_norm=%s", (uid, normalizar(item_nome)))
+        row = c.fetchone()
+    finally:
+        conn.close()
+    return tuple(row) if row else None
+
+def transferir_item(doador, alvo, item, qtd):
+    """Move qtd de item do doador para o alvo com a função transferir_item do banco.
+    Retorna (status, resumo), onde resumo traz nome, peso total e peso_max dos dois já atualizados.
+    Admin sem o item doa direto do catálogo. Status: "ok", "sem_item", "sem_catalogo" ou "sem_jogador"."""
+    peso_catalogo = None
+    if is_admin(doador):
+        item_info = get_catalog_item(item)
+        peso_catalogo = item_info["peso"] if item_info else None
+    conn = get_conn()
     c = conn.cursor()
-    c.execute("DELETE FROM inventario WHERE player_id=%s AND LOWER(nome)=LOWER(%s)", (uid, item_nome))
-    conn.commit()
-    conn.close()
+    try:
+        c.execute("SELECT * FROM transferir_item(%s, %s, %s, %s, %s, %s)",
+                  (doador, alvo, item, normalizar(item), qtd, peso_catalogo))
+        row = c.fetchone()
+        # Só grava com o status confirmado pela função
+        if row and row["status"] == "ok":
+            conn.commit()
+        else:
+            conn.rollback()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    if not row or row["status"] == "sem_jogador":
+        return "sem_jogador", None
+    if row["status"] != "ok":
+        if is_admin(doador) and peso_catalogo is None:
+            return "sem_catalogo", None
+        return "sem_item", None
+    invalidate_player(doador, alvo)
+    return "ok", dict(row)
+
+def abandonar_item(uid, item_nome, qtd):
+    return _inv_executar(uid, inv_retirar, item_nome, qtd) is not None
+
+def consumir_item(uid, item_nome, qtd):
+    # Checa se continua sendo consumível no catálogo
+    cat = get_catalog_item(item_nome)
+    if not cat or not cat.get("consumivel"):
+        return "nao_consumivel"
+    if _inv_executar(uid, inv_retirar, item_nome, qtd) is None:
+        return "sem_item"
+    return "ok"
+
+# Pente da arma do jogador; sem estado próprio ainda, vale o do catálogo
+ARMA_PENTE_SQL = """
+    SELECT COALESCE(i.muni_atual, cat.muni_atual), COALESCE(i.muni_max, cat.muni_max)
+    FROM inventario i JOIN catalogo cat ON cat.nome_norm = i.nome_norm
+    WHERE i.player_id = %(uid)s AND i.nome_norm = %(norm)s
+    FOR UPDATE OF i
+"""
+
+# Um disparo: tira uma bala do pente do próprio jogador, se houver
+ARMA_DISPARAR_SQL = """
+    UPDATE inventario i
+       SET muni_atual = COALESCE(i.muni_atual, cat.muni_atual) - 1,
+           muni_max = COALESCE(i.muni_max, cat.muni_max)
+      FROM catalogo cat
+     WHERE i.player_id = %(uid)s AND i.nome_norm = %(norm)s AND cat.nome_norm = i.nome_norm
+       AND COALESCE(i.muni_atual, cat.muni_atual) > 0
+    RETURNING i.muni_atual, i.muni_max
+"""
+
+def recarregar_arma(uid, arma_nome, mun_nome):
+    """Consome 1 munição e enche o pente da arma do jogador.
+    Retorna (status, munição antes, máximo); status "ok", "sem_arma" ou "sem_municao"."""
+    norm = normalizar(arma_nome)
+    conn = get_conn()
+    c = conn.cursor()
+    try:
+        c.execute(ARMA_PENTE_SQL, {"uid": uid, "norm": norm})
+        row = c.fetchone()
+        if not row:
+            return "sem_arma", None, None
+        antes, maximo = row
+        if inv_retirar(c, uid, mun_nome, 1) is None:
+            conn.rollback()
+            return "sem_municao", antes, maximo
+        c.execute("UPDATE inventario SET muni_atual=%s, muni_max=%s WHERE player_id=%s AND nome_norm=%s",
+                  (maximo, maximo, uid, norm))
+        conn.commit()
+        invalidate_player(uid)
+        return "ok", antes, maximo
+    finally:
+        conn.close()
+
+def disparar_arma(uid, arma_nome):
+    """Gasta uma bala da arma do jogador. Retorna (status, munição restante, máximo);
+    status "ok", "vazia" ou "sem_arma" (não tem a arma no inventário)."""
+    norm = normalizar(arma_nome)
+    conn = get_conn()
+    c = conn.cursor()
+    try:
+        c.execute(ARMA_DISPARAR_SQL, {"uid": uid, "norm": norm})
+        row = c.fetchone()
+        if row:
+            conn.commit()
+            invalidate_player(uid)
+            return "ok", row[0], row[1]
+        c.execute(ARMA_PENTE_SQL, {"uid": uid, "norm": norm})
+        row = c.fetchone()
+        conn.rollback()
+        if not row:
+            return "sem_arma", None, None
+        return "vazia", row[0], row[1]
+    finally:
+        conn.close()
 
 def peso_total(player):
     return sum(i['peso'] * i.get('quantidade', 1) for i in player.get("inventario", []))
 
+def consumivel_direto(cat):
+    """Consumível sem bônus nem tipo: o único que /consumir aceita."""
+    return bool(cat and cat.get("consumivel") and not cat.get("bonus") and cat.get("tipo") in ("nenhum", None, ""))
+
+def serve_para_dano(cat):
+    return bool(cat and (cat['arma_tipo'] or (cat['consumivel'] and cat['bonus'] and cat['tipo'] == "dano")))
+
+def serve_para_cura(cat, nome):
+    if cat:
+        return bool(cat['consumivel'] and cat['tipo'] == "cura")
+    return nome.lower() in KIT_BONUS
+
 def penalidade(player):
     return peso_total(player) > player["peso_max"]
 
@@ -401,57 +1467,63 @@ def parse_float_br(s: str) -> float | None:
     except:
         return None
 
-def ensure_peso_max_by_forca(uid: int):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT valor FROM atributos WHERE player_id=%s AND nome='Força'", (uid,))
-    row = c.fetchone()
-    if row:
-        valor_forca = max(1, min(6, int(row[0])))
-        novo = PESO_MAX.get(valor_forca, 0)
-        c.execute("UPDATE players SET peso_max=%s WHERE id=%s", (novo, uid))
-        conn.commit()
-    conn.close()
-
 def add_coma_bonus(target_id: int, delta: int):
     conn = get_conn()
-    c = conn.cursor()
-    c.execute("INSERT INTO coma_bonus(target_id, bonus) VALUES(%s,0) ON CONFLICT (target_id) DO NOTHING", (target_id,))
-    c.execute("UPDATE coma_bonus SET bonus = bonus + %s WHERE target_id=%s", (delta, target_id))
-    conn.commit()
-    conn.close()
+    try:
+        c = conn.cursor()
+        c.execute("INSERT INTO coma_bonus(target_id, bonus) VALUES(%s,0) ON CONFLICT (target_id) DO NOTHING", (target_id,))
+        c.execute("UPDATE coma_bonus SET bonus = bonus + %s WHERE target_id=%s", (delta, target_id))
+        conn.commit()
+    finally:
+        conn.close()
 
 def pop_coma_bonus(target_id: int) -> int:
     conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT bonus FROM coma_bonus WHERE target_id=%s", (target_id,))
-    row = c.fetchone()
-    bonus = row[0] if row else 0
-    c.execute("DELETE FROM coma_bonus WHERE target_id=%s", (target_id,))
-    conn.commit()
-    conn.close()
+    try:
+        c = conn.cursor()
+        c.execute("SELECT bonus FROM coma_bonus WHERE target_id=%s", (target_id,))
+        row = c.fetchone()
+        bonus = row[0] if row else 0
+        c.execute("DELETE FROM coma_bonus WHERE target_id=%s", (target_id,))
+        conn.commit()
+    finally:
+        conn.close()
     return bonus
 
-def reset_diario_rerolls():
-    while True:
-        try:
-            now = datetime.now()
-            next_reset = now.replace(hour=6, minute=0, second=0, microsecond=0)
-            if now >= next_reset:
-                next_reset += timedelta(days=1)
-            wait_seconds = (next_reset - now).total_seconds()
-            time.sleep(wait_seconds)
-            
-            conn = get_conn()
-            c = conn.cursor()
-            c.execute("UPDATE players SET rerolls=3")
-            conn.commit()
-            conn.close()
-            logger.info("🔄 Rerolls diários resetados!")
-            
-        except Exception as e:
-            logger.error(f"Erro no reset de rerolls: {e}")
-            time.sleep(60)
+def dia_rerolls():
+    """Dia de rerolls: vira às 06:00, não à meia-noite."""
+    return (datetime.now() - timedelta(hours=6)).date()
+
+def rerolls_disponiveis(player):
+    """Saldo de rerolls considerando a renovação diária (o banco só é atualizado no uso)."""
+    if player['rerolls_dia'] < dia_rerolls():
+        return REROLLS_DIARIOS
+    return player['rerolls']
+
+# Gasta um reroll, renovando o saldo antes se ele for de um dia anterior; sem linha = sem saldo
+USAR_REROLL_SQL = """
+    UPDATE players SET
+        rerolls = CASE WHEN rerolls_dia < %(dia)s THEN %(cheio)s ELSE rerolls END - 1,
+        rerolls_dia = %(dia)s
+    WHERE id = %(uid)s AND (rerolls_dia < %(dia)s OR rerolls > 0)
+    RETURNING rerolls
+"""
+
+def usar_reroll(uid):
+    """Gasta um reroll; retorna o saldo restante ou None se não havia."""
+    dia = dia_rerolls()
+    conn = get_conn()
+    try:
+        c = conn.cursor()
+        c.execute(USAR_REROLL_SQL, {"uid": uid, "dia": dia, "cheio": REROLLS_DIARIOS})
+        row = c.fetchone()
+        conn.commit()
+    finally:
+        conn.close()
+    if row is None:
+        return None
+    _cache_update(uid, lambda p: p.update({"rerolls": row[0], "rerolls_dia": dia}))
+    return row[0]
 
 def is_admin(uid: int) -> bool:
     return uid in ADMIN_IDS
@@ -462,40 +1534,112 @@ def mention(user):
     return user.first_name or "Jogador"
 
 def cleanup_expired_transfers():
-    while True:
-        try:
-            now = time.time()
-            expired_keys = []
-            for key, transfer in TRANSFER_PENDING.items():
-                if now > transfer.get('expires', now):
-                    expired_keys.append(key)
-            
-            for key in expired_keys:
-                TRANSFER_PENDING.pop(key, None)
-                
-            time.sleep(300)
-        except Exception as e:
-            logger.error(f"Erro na limpeza de transferências: {e}")
-            time.sleep(60)
+    """Remove transferências e sugestões expiradas (roda no event loop, junto dos handlers)."""
+    now = time.time()
+    for pendentes in (TRANSFER_PENDING, SUGESTOES_PENDENTES):
+        expired_keys = [key for key, p in pendentes.items() if now > p.get('expires', now)]
+        for key in expired_keys:
+            pendentes.pop(key, None)
 
 def semana_atual():
     hoje = datetime.now()
     segunda = hoje - timedelta(days=hoje.weekday())
     return segunda.date()
 
-def xp_por_caracteres(n):
-    if n < 500:
-        return 0
-    elif n < 1000:
-        return 10
-    elif n < 1500:
-        return 15
-    elif n < 2000:
-        return 20
-    elif n <= 4096:
-        return 25
-    else:
-        return 25
+# /turno inteiro numa ida ao banco, numa transação:
+#  - menções que não estavam em memória são resolvidas pela tabela usernames;
+#  - streak de hoje: dias seguidos da semana terminando ontem, + 1. Dias consecutivos têm
+#    data - ROW_NUMBER() igual (mesma "ilha"); conta a ilha que contém ontem;
+#  - o INSERT em turnos é a trava do "um por dia": se já havia turno, nada mais é gravado;
+#  - interação mútua: quem eu mencionei e, no turno de hoje, também me mencionou (índice GIN),
+#    +5 para cada lado de cada par;
+#  - devolve as linhas de xp_semana alteradas, para o ranking em memória.
+TURNO_SQL = """
+    WITH resolvidos AS (
+        SELECT username, user_id FROM usernames WHERE username = ANY(%(faltando)s::TEXT[])
+    ), alvos AS (
+        SELECT ARRAY(
+            SELECT DISTINCT id
+            FROM (SELECT unnest(%(ids)s::BIGINT[]) AS id UNION SELECT user_id FROM resolvidos) a
+            WHERE id <> %(uid)s
+            ORDER BY id) AS ids
+    ), d AS (
+        SELECT data, data - (ROW_NUMBER() OVER (ORDER BY data))::INTEGER AS ilha
+        FROM turnos
+        WHERE player_id = %(uid)s AND data >= %(semana)s AND data < %(hoje)s
+    ), s AS (
+        SELECT (COUNT(*) + 1)::INTEGER AS streak, xp_por_caracteres(%(caracteres)s) AS xp
+        FROM d
+        WHERE ilha = (SELECT ilha FROM d WHERE data = %(hoje)s::DATE - 1)
+    ), b AS (
+        SELECT streak, xp, CASE streak WHEN 3 THEN 5 WHEN 5 THEN 10 WHEN 7 THEN 20 ELSE 0 END AS bonus
+        FROM s
+    ), ins AS (
+        INSERT INTO turnos (player_id, data, caracteres, mencoes, mencoes_ids)
+        SELECT %(uid)s, %(hoje)s, %(caracteres)s, %(mencoes)s, alvos.ids FROM alvos
+        ON CONFLICT (player_id, data) DO NOTHING
+        RETURNING mencoes_ids
+    ), mutuos AS (
+        SELECT t.player_id
+        FROM ins, turnos t
+        WHERE t.data = %(hoje)s AND t.player_id = ANY(ins.mencoes_ids)
+          AND t.mencoes_ids @> ARRAY[%(uid)s]::BIGINT[]
+    ), autor AS (
+        INSERT INTO xp_semana AS x (player_id, semana_inicio, xp_total, streak_atual)
+        SELECT %(uid)s, %(semana)s, LEAST(b.xp + b.bonus, 25) + 5 * (SELECT COUNT(*) FROM mutuos), b.streak
+        FROM ins, b
+        ON CONFLICT (player_id, semana_inicio) DO UPDATE
+            SET xp_total = x.xp_total + EXCLUDED.xp_total, streak_atual = EXCLUDED.streak_atual
+        RETURNING x.player_id, x.xp_total, x.streak_atual
+    ), parceiros AS (
+        UPDATE xp_semana x SET xp_total = x.xp_total + 5
+        FROM mutuos m
+        WHERE x.player_id = m.player_id AND x.semana_inicio = %(semana)s
+        RETURNING x.player_id, x.xp_total, x.streak_atual
+    )
+    SELECT EXISTS (SELECT 1 FROM ins), b.xp, b.streak, b.bonus,
+           ARRAY(SELECT player_id FROM mutuos ORDER BY player_id),
+           (SELECT json_agg(json_build_array(r.player_id, p.nome, r.xp_total, r.streak_atual))
+              FROM (SELECT * FROM autor UNION ALL SELECT * FROM parceiros) r
+              LEFT JOIN players p ON p.id = r.player_id),
+           (SELECT json_agg(json_build_array(username, user_id)) FROM resolvidos)
+    FROM b
+"""
+
+def registrar_turno(uid, username, hoje, semana, caracteres, mencoes):
+    """Grava o turno do dia e o XP da semana. Retorna None se já havia turno hoje, senão
+    (XP do texto, streak, bônus de streak, pares com interação mútua)."""
+    ids, faltando = ids_em_memoria(mencoes)
+    ids.pop(_normalizar_tag(username or ""), None)
+    params = {
+        "uid": uid, "hoje": hoje, "semana": semana, "caracteres": caracteres,
+        "mencoes": ",".join(mencoes), "ids": list(ids.values()), "faltando": faltando,
+    }
+    conn = get_conn()
+    c = conn.cursor()
+    try:
+        try:
+            c.execute(TURNO_SQL, params)
+        except psycopg2.errors.CheckViolation:
+            # Sem partição para a semana ("no partition of relation found"): cria e tenta de novo
+            conn.rollback()
+            garantir_particoes(c, semana)
+            c.execute(TURNO_SQL, params)
+        registrado, xp, streak_atual, bonus_streak, mutuos, linhas, resolvidos = c.fetchone()
+        conn.commit()
+    finally:
+        conn.close()
+    if resolvidos:
+        with USERNAMES_LOCK:
+            for uname, mid in resolvidos:
+                _username_id_put(uname, mid)
+                ids.setdefault(uname, mid)
+    if not registrado:
+        return None
+    LEADERBOARD.atualizar(semana, [tuple(l) for l in linhas or []])
+    nomes = {mid: uname for uname, mid in ids.items()}
+    bonificados = [(nomes.get(mid, str(mid)), mid) for mid in mutuos]
+    return xp, streak_atual, bonus_streak, bonificados
 
 async def turno(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.chat.type == 'private':
@@ -512,19 +1656,8 @@ async def turno(update: Update, context: ContextTypes.DEFAULT_TYPE):
     texto_limpo = re.sub(r'^/turno(?:@\w+)?', '', texto, flags=re.IGNORECASE).strip()
     caracteres = len(texto_limpo)
 
-    conn = get_conn()
-    c = conn.cursor()
-
-    # Bloqueia segunda tentativa no mesmo dia apenas se já houver um turno VÁLIDO registrado
-    c.execute("SELECT 1 FROM turnos WHERE player_id=%s AND data=%s", (uid, hoje))
-    if c.fetchone():
-        conn.close()
-        await update.message.reply_text("Você já enviou seu turno hoje! Apenas 1 por dia é contabilizado.")
-        return
-
     # 🚨 Caso a pessoa mande só /turno sem texto
     if not texto_limpo:
-        conn.close()
         await update.message.reply_text(
             "ℹ️ Para registrar um turno, use este comando seguido do seu texto.\n\n"
             "Exemplo:\n"
@@ -536,78 +1669,34 @@ async def turno(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # ✅ Validação de tamanho mínimo: não salva nada quando inválido
     if caracteres < 499:
-        conn.close()  # garante que a conexão não fique aberta
         await update.message.reply_text(
             f"⚠️ Seu turno precisa ter pelo menos 499 caracteres! (Atualmente: {caracteres})\n"
             "Nada foi registrado. Envie novamente com mais conteúdo."
         )
         return
 
-    mencoes = set(re.findall(r"@(\w+)", texto_limpo))
+    mencoes = set(m.lower() for m in re.findall(r"@(\w+)", texto_limpo))
     if username:
         mencoes.discard(username.lower())
     mencoes = list(mencoes)
     if len(mencoes) > 5:
         mencoes = mencoes[:5]
         await update.message.reply_text("⚠️ Só é possível mencionar até 5 jogadores por turno. Apenas os 5 primeiros serão considerados.")
-    mencoes_str = ",".join(mencoes) if mencoes else ""
 
-    xp = xp_por_caracteres(caracteres)
-
-    c.execute("SELECT data FROM turnos WHERE player_id=%s AND data >= %s ORDER BY data", (uid, semana))
-    dias = [row[0] for row in c.fetchall()]
-    streak_atual = 1
-    if dias:
-        prev = dias[-1]
-        if (hoje - prev).days == 1:
-            streak_atual = len(dias) + 1
-        else:
-            streak_atual = 1
-
-    bonus_streak = 0
-    if streak_atual == 3:
-        bonus_streak = 5
-    elif streak_atual == 5:
-        bonus_streak = 10
-    elif streak_atual == 7:
-        bonus_streak = 20
-
-    xp_dia = min(xp + bonus_streak, 25)
-
-    # Só insere porque já passou na validação (>= 499)
-    c.execute(
-        "INSERT INTO turnos (player_id, data, caracteres, mencoes) VALUES (%s, %s, %s, %s)",
-        (uid, hoje, caracteres, mencoes_str)
-    )
-    c.execute(
-        "INSERT INTO xp_semana (player_id, semana_inicio, xp_total, streak_atual) VALUES (%s, %s, %s, %s) "
-        "ON CONFLICT (player_id, semana_inicio) DO UPDATE SET xp_total = xp_semana.xp_total + %s, streak_atual = %s",
-        (uid, semana, xp_dia, streak_atual, xp_dia, streak_atual)
-    )
+    # Segunda tentativa no mesmo dia: o INSERT não acontece e nada é contabilizado
+    resultado = await db(registrar_turno, uid, username, hoje, semana, caracteres, mencoes)
+    if resultado is None:
+        await update.message.reply_text("Você já enviou seu turno hoje! Apenas 1 por dia é contabilizado.")
+        return
+    xp, streak_atual, bonus_streak, bonificados = resultado
 
     # Interação mútua diária
-    interacoes_bonificadas = set()
-    for mencionado in mencoes:
-        mencionado_id = username_to_id(f"@{mencionado}")
-        if mencionado_id and mencionado_id != uid:
-            c.execute("SELECT mencoes FROM turnos WHERE player_id=%s AND data=%s", (mencionado_id, hoje))
-            row = c.fetchone()
-            if row and row[0]:
-                mencoes_do_outra_pessoa = set(row[0].split(","))
-                if username and username.lower() in mencoes_do_outra_pessoa:
-                    par = tuple(sorted([uid, mencionado_id]))
-                    if par not in interacoes_bonificadas:
-                        c.execute("UPDATE xp_semana SET xp_total = xp_total + 5 WHERE player_id=%s AND semana_inicio=%s", (uid, semana))
-                        c.execute("UPDATE xp_semana SET xp_total = xp_total + 5 WHERE player_id=%s AND semana_inicio=%s", (mencionado_id, semana))
-                        interacoes_bonificadas.add(par)
-                        try:
-                            await context.bot.send_message(uid, f"🎉 Você e @{mencionado} mencionaram um ao outro no turno de hoje! Ambos ganharam +5 XP de interação mútua.", parse_mode="HTML")
-                            await context.bot.send_message(mencionado_id, f"🎉 Você e @{username} mencionaram um ao outro no turno de hoje! Ambos ganharam +5 XP de interação mútua.", parse_mode="HTML")
-                        except Exception as e:
-                            logger.warning(f"Falha ao enviar mensagem privada de bônus: {e}")
-
-    conn.commit()
-    conn.close()
+    for mencionado, mencionado_id in bonificados:
+        try:
+            await context.bot.send_message(uid, f"🎉 Você e @{mencionado} mencionaram um ao outro no turno de hoje! Ambos ganharam +5 XP de interação mútua.", parse_mode="HTML")
+            await context.bot.send_message(mencionado_id, f"🎉 Você e @{username} mencionaram um ao outro no turno de hoje! Ambos ganharam +5 XP de interação mútua.", parse_mode="HTML")
+        except Exception as e:
+            logger.warning(f"Falha ao enviar mensagem privada de bônus: {e}")
 
     msg = f"Turno registrado!\nCaracteres: {caracteres}\nXP ganho hoje: {xp}"
     if bonus_streak:
@@ -615,42 +1704,271 @@ async def turno(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg += f"\nStreak atual: {streak_atual} dias"
     await update.message.reply_text(msg)
 
-def ranking_semanal(context=None):
-    semana = semana_atual()
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT player_id, xp_total FROM xp_semana WHERE semana_inicio=%s ORDER BY xp_total DESC LIMIT 3", (semana,))
-    top = c.fetchall()
-    players = {pid: get_player(pid) for pid, _ in top}
-    lines = ["🏆 Ranking Final da Semana:"]
+# Total da semana e os turnos do dia a dia (com o XP de cada um) numa consulta só;
+# sem turnos, volta uma linha com as colunas do dia nulas.
+XP_SEMANA_SQL = """
+    SELECT x.xp_total, x.streak_atual, t.data, t.caracteres, t.mencoes, xp_por_caracteres(t.caracteres)
+    FROM (SELECT 1) um
+    LEFT JOIN xp_semana x ON x.player_id = %(uid)s AND x.semana_inicio = %(semana)s
+    LEFT JOIN turnos t ON t.player_id = %(uid)s AND t.data >= %(semana)s AND t.data < %(semana)s::DATE + 7
+    ORDER BY t.data
+"""
+
+def get_xp_semana(uid, semana):
+    """(xp total, streak, [(data, caracteres, menções, xp do dia)]) da semana."""
+    conn = get_conn()
+    try:
+        c = conn.cursor()
+        c.execute(XP_SEMANA_SQL, {"uid": uid, "semana": semana})
+        rows = c.fetchall()
+    finally:
+        conn.close()
+    xp_total, streak = rows[0][0] or 0, rows[0][1] or 0
+    dias = [tuple(r[2:]) for r in rows if r[2] is not None]
+    return xp_total, streak, dias
+
+# ================== RANKING EM MEMÓRIA ==================
+# O XP da semana só muda no /turno: o ranking fica ordenado em memória e o /turno
+# publica o XP final de quem mudou. Posição e top N são buscas binárias na lista.
+RANKING_LINHAS_SQL = """
+    SELECT x.player_id, p.nome, x.xp_total, x.streak_atual
+    FROM xp_semana x LEFT JOIN players p ON p.id = x.player_id
+    WHERE x.semana_inicio = %s
+"""
+
+class Leaderboard:
+    def __init__(self):
+        self.semana = None
+        self.versao = 0
+        self._ordem = []    # (-xp, player_id), sempre ordenada
+        self._dados = {}    # player_id -> (nome, xp, streak)
+        self._lock = threading.Lock()
+
+    def carregar(self, semana, linhas):
+        with self._lock:
+            self.semana = semana
+            self._dados = {pid: (nome, xp, streak) for pid, nome, xp, streak in linhas}
+            self._ordem = sorted((-xp, pid) for pid, (_, xp, _) in self._dados.items())
+            self.versao += 1
+        descartar_render("ranking")
+
+    def atualizar(self, semana, linhas):
+        with self._lock:
+            if semana != self.semana:
+                return  # semana ainda não carregada: a próxima leitura recarrega do banco
+            for pid, nome, xp, streak in linhas:
+                antigo = self._dados.get(pid)
+                if antigo:
+                    i = bisect.bisect_left(self._ordem, (-antigo[1], pid))
+                    del self._ordem[i]
+                bisect.insort(self._ordem, (-xp, pid))
+                self._dados[pid] = (nome, xp, streak)
+            self.versao += 1
+        descartar_render("ranking")
+
+    def _linha(self, pid):
+        nome, xp, streak = self._dados[pid]
+        # RANK(): 1 + quantos têm XP estritamente maior
+        pos = bisect.bisect_left(self._ordem, (-xp,)) + 1
+        return pid, nome, xp, streak, pos
+
+    def top(self, n):
+        with self._lock:
+            return [self._linha(pid) for _, pid in self._ordem[:n]]
+
+    def posicao(self, pid):
+        with self._lock:
+            return self._linha(pid) if pid in self._dados else None
+
+LEADERBOARD = Leaderboard()
+
+def carregar_ranking(semana=None):
+    semana = semana or semana_atual()
+    conn = get_conn()
+    try:
+        c = conn.cursor()
+        c.execute(RANKING_LINHAS_SQL, (semana,))
+        linhas = c.fetchall()
+    finally:
+        conn.close()
+    LEADERBOARD.carregar(semana, linhas)
+
+async def garantir_ranking():
+    """Recarrega o ranking do banco só na virada da semana."""
+    semana = semana_atual()
+    if LEADERBOARD.semana != semana:
+        await db(carregar_ranking, semana)
+
+def ranking_atual(uid, n=10):
+    """Retorna (top, voce): as n primeiras linhas (player_id, nome, xp, streak, pos) e a linha de uid fora do top, se houver."""
+    top = LEADERBOARD.top(n)
+    if any(pid == uid for pid, *_ in top):
+        return top, None
+    return top, LEADERBOARD.posicao(uid)
+
+async def ranking_semanal(app):
+    # Roda na segunda às 06:00: a semana que terminou é a anterior
+    atual = semana_atual()
+    semana = atual - timedelta(days=7)
+    await db(fechar_semanas, atual)
+    top = await db(get_ranking_arquivo, semana, 3)
+    lines = ["🏆 Ranking Final da Semana:"]
+    medals = ['🥇', '🥈', '🥉']
+    for idx, (pid, nome, xp, _, _) in enumerate(top):
+        nome = nome or f"ID:{pid}"
+        lines.append(f"{medals[idx]} <b>{nome}</b> – XP: {xp}")
+    texto = "\n".join(lines)
+
+    for admin_id in ADMIN_IDS:
+        try:
+            await app.bot.send_message(admin_id, texto, parse_mode='HTML')
+        except Exception as e:
+            logger.error(f"Falha ao enviar ranking para admin {admin_id}: {e}")
+
+# ================== CACHE DE RENDERIZAÇÃO ==================
+# Textos prontos de /ficha, /verficha, /itens e /ranking, guardados com a versão dos dados
+# de que vieram (ficha do jogador, foto do catálogo, ranking). Versão igual = mesmo texto;
+# quando os dados mudam, as entradas daquela visão são descartadas.
+RENDER_CACHE = OrderedDict()  # (visão, chave) -> (versão, texto)
+RENDER_LOCK = threading.Lock()
+
+def render_get(visao, chave, versao):
+    with RENDER_LOCK:
+        entry = RENDER_CACHE.get((visao, chave))
+        if entry is None or entry[0] != versao:
+            return None
+        RENDER_CACHE.move_to_end((visao, chave))
+        return entry[1]
+
+def render_cached(visao, chave, versao, gerar):
+    texto = render_get(visao, chave, versao)
+    if texto is not None:
+        return texto
+    texto = gerar()
+    with RENDER_LOCK:
+        RENDER_CACHE[(visao, chave)] = (versao, texto)
+        RENDER_CACHE.move_to_end((visao, chave))
+        while len(RENDER_CACHE) > RENDER_CACHE_MAX:
+            RENDER_CACHE.popitem(last=False)
+    return texto
+
+def descartar_render(visao, chave=...):
+    """Descarta uma entrada (ou todas as da visão, se a chave não for passada)."""
+    with RENDER_LOCK:
+        if chave is not ...:
+            RENDER_CACHE.pop((visao, chave), None)
+            return
+        for k in [k for k in RENDER_CACHE if k[0] == visao]:
+            del RENDER_CACHE[k]
+
+def render_ficha(player):
+    text = "\u200B\n「  ཀ  𝗗𝗘𝗔𝗗𝗟𝗜𝗡𝗘, ficha.  」​\u200B\n\n ✦︎  𝗔𝘁𝗿𝗶𝗯𝘂𝘁𝗼𝘀  \n"
+    for a in ATRIBUTOS_LISTA:
+        val = player["atributos"].get(a, 0)
+        text += f" — {a}﹕{val}\n"
+    text += "\n ✦︎  𝗣𝗲𝗿𝗶𝗰𝗶𝗮𝘀  \n"
+    for p in PERICIAS_LISTA:
+        val = player["pericias"].get(p, 0)
+        text += f" — {p}﹕{val}\n"
+    text += f"\n 𖹭  𝗛𝗣  (Vida)  ▸  {player['hp']} / 40\n 𖦹  𝗦𝗣  (Sanidade)  ▸  {player['sp']} / 40\n"
+    total_peso = peso_total(player)
+    sobre = "  ⚠︎  Você está com <b>SOBRECARGA</b>!" if penalidade(player) else ""
+    text += f"\n 𖠩  𝗣𝗲𝘀𝗼 𝗧𝗼𝘁𝗮𝗹 ﹕ {total_peso:.1f} / {player['peso_max']}{sobre}\n\n"
+    penal = penalidade_sobrecarga(player)
+    if penal:
+        text += f"⚠︎ Penalidade ativa: {penal} em Força, Destreza e Furtividade!\n"
+    text += "<blockquote>Para editar Atributos e Perícias, utilize o comando /editarficha.</blockquote>\n<blockquote>Para gerenciar seu Inventário, utilize o comando /inventario.</blockquote>\n\u200B"
+    return text
+
+def render_verficha(player):
+    # Monta a ficha (mesmo formato do comando /ficha)
+    text = f"\u200B\n 「  ཀ  𝗗𝗘𝗔𝗗𝗟𝗜𝗡𝗘, ficha de {player['nome']}.  」​\u200B\n\n ✦︎  𝗔𝘁𝗿𝗶𝗯𝘂𝘁𝗼𝘀  \n"
+    for a in ATRIBUTOS_LISTA:
+        val = player["atributos"].get(a, 0)
+        text += f" — {a}﹕{val}\n"
+    text += "\n ✦︎  𝗣𝗲𝗿𝗶𝗰𝗶𝗮𝘀  \n"
+    for p in PERICIAS_LISTA:
+        val = player["pericias"].get(p, 0)
+        text += f" — {p}﹕{val}\n"
+    text += f"\n 𖹭  𝗛𝗣  (Vida)  ▸  {player['hp']} / 40\n 𖦹  𝗦𝗣  (Sanidade)  ▸  {player['sp']} / 40\n"
+    
+    total_peso = peso_total(player)
+    sobre = "  ⚠︎  Jogador está com <b>SOBRECARGA</b>!" if penalidade(player) else ""
+    text += f"\n 𖠩  𝗣𝗲𝘀𝗼 𝗧𝗼𝘁𝗮𝗹 ﹕ {total_peso:.1f} / {player['peso_max']}{sobre}\n"
+    
+    # Adiciona informações extras para admin
+    text += f"\n📊 <b>Info Admin:</b>\n"
+    text += f" — ID: {player['id']}\n"
+    text += f" — Username: @{player['username'] or 'N/A'}\n"
+    text += f" — Rerolls: {rerolls_disponiveis(player)}/{REROLLS_DIARIOS}\n\u200B"
+    return text
+
+def _linha_item(row):
+    nome, peso, consumivel, bonus, tipo, arma_tipo, arma_bonus, muni_atual, muni_max, armas_compat = row
+    if arma_tipo:
+        info = f" ({arma_tipo})"
+        if arma_tipo == 'range':
+            info += f", {muni_atual}/{muni_max}"
+        info += f" (+{arma_bonus})"
+    elif consumivel:
+        info = f" (consumível)"
+        if bonus:
+            info += f" (+{bonus})"
+        if tipo:
+            info += f" [{tipo}]"
+        if tipo == 'municao' and armas_compat:
+            info += f" | Armas: {armas_compat}"
+    else:
+        info = ""
+    return f" — {nome} ({peso:.2f} kg){info}"
+
+def _cursor_itens(filtro, versao, ini):
+    """callback_data do /itens: filtro, versão da foto e posição do primeiro item da página."""
+    return f"itens_{filtro}_{versao}_{ini}"
+
+def render_itens(snap, filtro="todos", ini=0):
+    """Uma página do catálogo e o teclado de navegação/filtros."""
+    rows, ini, total = snap.pagina(filtro, ini)
+    rotulo = FILTROS_CATALOGO[filtro][0]
+    lines = [f"\u200B\n ☰  Catálogo de Itens — {rotulo}\n"]
+    if rows:
+        lines.append(f" {ini + 1}–{ini + len(rows)} de {total}\n")
+        lines.extend(_linha_item(row) for row in rows)
+    else:
+        lines.append(" Nenhum item neste filtro.")
+    nav = []
+    if rows and ini > 0:
+        nav.append(InlineKeyboardButton("⬅️ Anterior", callback_data=_cursor_itens(filtro, snap.versao, max(0, ini - ITENS_POR_PAGINA))))
+    if rows and ini + len(rows) < total:
+        nav.append(InlineKeyboardButton("Próxima ➡️", callback_data=_cursor_itens(filtro, snap.versao, ini + len(rows))))
+    filtros = [InlineKeyboardButton(("• " if f == filtro else "") + r, callback_data=_cursor_itens(f, snap.versao, 0))
+               for f, (r, _) in FILTROS_CATALOGO.items()]
+    teclado = InlineKeyboardMarkup([nav, filtros] if nav else [filtros])
+    return "\n".join(lines), teclado
+
+def render_ranking(uid):
+    top, voce = ranking_atual(uid)
+
+    lines = ["🏆 <b>Ranking semanal (Top 10)</b>"]
     medals = ['🥇', '🥈', '🥉']
-    for idx, (pid, xp) in enumerate(top):
-        nome = players[pid]['nome'] if players.get(pid) else f"ID:{pid}"
-        lines.append(f"{medals[idx]} <b>{nome}</b> – XP: {xp}")
-    texto = "\n".join(lines)
 
-    if context:
-        for admin_id in ADMIN_IDS:
-            try:
-                context.bot.send_message(admin_id, texto, parse_mode='HTML')
-            except Exception as e:
-                logger.error(f"Falha ao enviar ranking para admin {admin_id}: {e}")
+    for idx, (pid, nome, xp, streak, _) in enumerate(top):
+        nome = nome or f"ID:{pid}"
+        medal = medals[idx] if idx < len(medals) else f"{idx+1}."
+        highlight = " <b>(Você)</b>" if pid == uid else ""
+        lines.append(f"{medal} <b>{nome}</b> — {xp} XP | 🔥 Streak: {streak}d{highlight}")
 
-    c.execute("DELETE FROM xp_semana WHERE semana_inicio=%s", (semana,))
-    conn.commit()
-    conn.close()
+    if not top:
+        lines.append("Ninguém tem XP ainda nesta semana!")
 
-def thread_reset_xp():
-    while True:
-        now = datetime.now()
-        proxima = now.replace(hour=6, minute=0, second=0, microsecond=0)
-        while proxima.weekday() != 0:
-            proxima += timedelta(days=1)
-        if now >= proxima:
-            proxima += timedelta(days=7)
-        wait = (proxima - now).total_seconds()
-        time.sleep(wait)
-        ranking_semanal()
+    # Se o jogador não estiver no Top 10, mostra posição separada
+    if voce:
+        pid, nome, xp, streak, pos = voce
+        nome = nome or f"ID:{pid}"
+        lines.append(
+            f"\n➡️ Sua posição: {pos}º — <b>{nome}</b> — {xp} XP | 🔥 Streak: {streak}d"
+        )
+    return "\n".join(lines)
 
 # ================== COMANDOS ==================
 
@@ -661,11 +1979,11 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
     nome = update.effective_user.first_name
     username = update.effective_user.username
-    if not get_player(uid):
-        create_player(uid, nome, username)
+    if not await db(get_player, uid):
+        await db(create_player, uid, nome, username)
         register_username(uid, username, nome)
-        update_player_field(uid, 'hp_max', 40)
-        update_player_field(uid, 'sp_max', 40)
+        await db(update_player_field, uid, 'hp_max', 40)
+        await db(update_player_field, uid, 'sp_max', 40)
     await update.message.reply_text(
     f"\u200B\n 𐚁  𝗕𝗼𝗮𝘀 𝘃𝗶𝗻𝗱𝗮𝘀, {nome} ! \n\n"
     "Este bot gerencia seus Dados, Ficha, Inventário, Vida e Sanidade, além de diversos outros sistemas que você poderá explorar.\n\n"
@@ -682,26 +2000,15 @@ async def ficha(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     uid = update.effective_user.id
     register_username(uid, update.effective_user.username, update.effective_user.first_name)
-    player = get_player(uid)
-    if not player:
-        await update.message.reply_text("Você precisa usar /start primeiro!")
-        return
-    text = "\u200B\n「  ཀ  𝗗𝗘𝗔𝗗𝗟𝗜𝗡𝗘, ficha.  」​\u200B\n\n ✦︎  𝗔𝘁𝗿𝗶𝗯𝘂𝘁𝗼𝘀  \n"
-    for a in ATRIBUTOS_LISTA:
-        val = player["atributos"].get(a, 0)
-        text += f" — {a}﹕{val}\n"
-    text += "\n ✦︎  𝗣𝗲𝗿𝗶𝗰𝗶𝗮𝘀  \n"
-    for p in PERICIAS_LISTA:
-        val = player["pericias"].get(p, 0)
-        text += f" — {p}﹕{val}\n"
-    text += f"\n 𖹭  𝗛𝗣  (Vida)  ▸  {player['hp']} / 40\n 𖦹  𝗦𝗣  (Sanidade)  ▸  {player['sp']} / 40\n"
-    total_peso = peso_total(player)
-    sobre = "  ⚠︎  Você está com <b>SOBRECARGA</b>!" if penalidade(player) else ""
-    text += f"\n 𖠩  𝗣𝗲𝘀𝗼 𝗧𝗼𝘁𝗮𝗹 ﹕ {total_peso:.1f} / {player['peso_max']}{sobre}\n\n"
-    penal = penalidade_sobrecarga(player)
-    if penal:
-        text += f"⚠︎ Penalidade ativa: {penal} em Força, Destreza e Furtividade!\n"
-    text += "<blockquote>Para editar Atributos e Perícias, utilize o comando /editarficha.</blockquote>\n<blockquote>Para gerenciar seu Inventário, utilize o comando /inventario.</blockquote>\n\u200B"
+    # Versão lida antes da ficha: se ela mudar no meio, o texto fica guardado sob a versão velha
+    versao = player_version(uid)
+    text = render_get("ficha", uid, versao)
+    if text is None:
+        player = await db(get_player, uid)
+        if not player:
+            await update.message.reply_text("Você precisa usar /start primeiro!")
+            return
+        text = render_cached("ficha", uid, versao, lambda: render_ficha(player))
     await update.message.reply_text(text, parse_mode="HTML")
 
 async def editarficha(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -710,7 +2017,7 @@ async def editarficha(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     uid = update.effective_user.id
-    player = get_player(uid)
+    player = await db(get_player, uid)
     if not player:
         await update.message.reply_text("Use /start primeiro!")
         return
@@ -721,14 +2028,13 @@ async def editarficha(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if uid in EDIT_TIMERS:
         EDIT_TIMERS[uid].cancel()
     
-    # Criar timer de 5 minutos para timeout
+    # Criar timer de 5 minutos para timeout (no próprio event loop)
     def timeout_edit():
         EDIT_PENDING.pop(uid, None)
         EDIT_TIMERS.pop(uid, None)
         logger.info(f"Timeout de edição para usuário {uid}")
     
-    EDIT_TIMERS[uid] = threading.Timer(300.0, timeout_edit)
-    EDIT_TIMERS[uid].start()
+    EDIT_TIMERS[uid] = asyncio.get_running_loop().call_later(300.0, timeout_edit)
     
     text = (
         "\u200B\nPara editar os pontos em sua ficha, responda em apenas uma mensagem todas as alterações que deseja realizar. Você pode mudar quantos Atributos e Perícias quiser de uma só vez! \n\n"
@@ -748,7 +2054,7 @@ async def receber_edicao(update: Update, context: ContextTypes.DEFAULT_TYPE):
         register_username(uid, update.effective_user.username, update.effective_user.first_name)
         return
 
-    player = get_player(uid)
+    player = await db(get_player, uid)
     if not player:
         await update.message.reply_text("Use /start primeiro!")
         return
@@ -795,14 +2101,10 @@ async def receber_edicao(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text(f"❌ Campo não reconhecido: {key}")
             return
 
-    player["atributos"] = {k: EDIT_TEMP[k] for k in ATRIBUTOS_LISTA}
-    player["pericias"] = {k: EDIT_TEMP[k] for k in PERICIAS_LISTA}
-
-    for atr in ATRIBUTOS_LISTA:
-        update_atributo(uid, atr, player["atributos"][atr])
-    for per in PERICIAS_LISTA:
-        update_pericia(uid, per, player["pericias"][per])
-    ensure_peso_max_by_forca(uid)
+    # Só vai para o banco o que mudou de fato
+    atr_mudados = {k: EDIT_TEMP[k] for k in ATRIBUTOS_LISTA if EDIT_TEMP[k] != player["atributos"].get(k)}
+    per_mudados = {k: EDIT_TEMP[k] for k in PERICIAS_LISTA if EDIT_TEMP[k] != player["pericias"].get(k)}
+    await db(salvar_ficha, uid, atr_mudados, per_mudados, EDIT_TEMP["Força"])
 
     await update.message.reply_text(" ✅ Ficha atualizada com sucesso!")
     
@@ -828,38 +2130,21 @@ async def verficha(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Uso: /verficha @jogador")
         return
     
-    user_tag = context.args[0]
-    target_id = username_to_id(user_tag)
+    target_id, user_tag, _ = await resolver_alvo(update.message, context.args)
     if not target_id:
         await update.message.reply_text("❌ Jogador não encontrado. Peça para a pessoa usar /start pelo menos uma vez.")
         return
     
-    player = get_player(target_id)
-    if not player:
-        await update.message.reply_text("❌ Jogador não encontrado no sistema.")
-        return
-    
-    # Monta a ficha (mesmo formato do comando /ficha)
-    text = f"\u200B\n 「  ཀ  𝗗𝗘𝗔𝗗𝗟𝗜𝗡𝗘, ficha de {player['nome']}.  」​\u200B\n\n ✦︎  𝗔𝘁𝗿𝗶𝗯𝘂𝘁𝗼𝘀  \n"
-    for a in ATRIBUTOS_LISTA:
-        val = player["atributos"].get(a, 0)
-        text += f" — {a}﹕{val}\n"
-    text += "\n ✦︎  𝗣𝗲𝗿𝗶𝗰𝗶𝗮𝘀  \n"
-    for p in PERICIAS_LISTA:
-        val = player["pericias"].get(p, 0)
-        text += f" — {p}﹕{val}\n"
-    text += f"\n 𖹭  𝗛𝗣  (Vida)  ▸  {player['hp']} / 40\n 𖦹  𝗦𝗣  (Sanidade)  ▸  {player['sp']} / 40\n"
-    
-    total_peso = peso_total(player)
-    sobre = "  ⚠︎  Jogador está com <b>SOBRECARGA</b>!" if penalidade(player) else ""
-    text += f"\n 𖠩  𝗣𝗲𝘀𝗼 𝗧𝗼𝘁𝗮𝗹 ﹕ {total_peso:.1f} / {player['peso_max']}{sobre}\n"
-    
-    # Adiciona informações extras para admin
-    text += f"\n📊 <b>Info Admin:</b>\n"
-    text += f" — ID: {player['id']}\n"
-    text += f" — Username: @{player['username'] or 'N/A'}\n"
-    text += f" — Rerolls: {player['rerolls']}/3\n\u200B"
-    
+    # O saldo de rerolls exibido muda na virada do dia sem a ficha mudar de versão
+    versao = (player_version(target_id), dia_rerolls())
+    text = render_get("verficha", target_id, versao)
+    if text is None:
+        player = await db(get_player, target_id)
+        if not player:
+            await update.message.reply_text("❌ Jogador não encontrado no sistema.")
+            return
+        text = render_cached("verficha", target_id, versao, lambda: render_verficha(player))
+
     await update.message.reply_text(text, parse_mode="HTML")
 
 async def inventario(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -868,7 +2153,7 @@ async def inventario(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     uid = update.effective_user.id
     register_username(uid, update.effective_user.username, update.effective_user.first_name)
-    player = get_player(uid)
+    player = await db(get_player, uid)
     if not player:
         await update.message.reply_text("Use /start primeiro!")
         return
@@ -876,8 +2161,15 @@ async def inventario(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not player['inventario']:
         lines.append("  Vazio.")
     else:
+        snap = await catalogo()
         for i in sorted(player['inventario'], key=lambda x: x['nome'].lower()):
-            lines.append(f"  — {i['nome']} x{i['quantidade']} ({i['peso']:.2f} kg cada)")
+            linha = f"  — {i['nome']} x{i['quantidade']} ({i['peso']:.2f} kg cada)"
+            cat = snap.get(i['nome'])
+            if cat and cat['arma_tipo'] == 'range':
+                atual = i.get('muni_atual') if i.get('muni_atual') is not None else cat['muni_atual']
+                maximo = i.get('muni_max') if i.get('muni_max') is not None else cat['muni_max']
+                linha += f" [{atual}/{maximo}]"
+            lines.append(linha)
     total_peso = peso_total(player)
     lines.append(f"\n  𝗣𝗲𝘀𝗼 𝗧𝗼𝘁𝗮𝗹﹕{total_peso:.1f}/{player['peso_max']} kg\n\u200B")
     if penalidade(player):
@@ -892,30 +2184,38 @@ async def itens(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not anti_spam(update.effective_user.id):
         await update.message.reply_text("⏳ Espere um instante antes de usar outro comando.")
         return
-    data = list_catalog()
-    if not data:
+    snap = await catalogo()
+    if not snap.itens:
         await update.message.reply_text("\u200B\n ☰  Catálogo\n Vazio.\n Use /additem Nome Peso para adicionar.\n\u200B")
         return
-    lines = ["\u200B\n ☰  Catálogo de Itens\n\n"]
-    for row in data:
-        nome, peso, consumivel, bonus, tipo, arma_tipo, arma_bonus, muni_atual, muni_max, armas_compat = row
-        if arma_tipo:
-            info = f" ({arma_tipo})"
-            if arma_tipo == 'range':
-                info += f", {muni_atual}/{muni_max}"
-            info += f" (+{arma_bonus})"
-        elif consumivel:
-            info = f" (consumível)"
-            if bonus:
-                info += f" (+{bonus})"
-            if tipo:
-                info += f" [{tipo}]"
-            if tipo == 'municao' and armas_compat:
-                info += f" | Armas: {armas_compat}"
-        else:
-            info = ""
-        lines.append(f" — {nome} ({peso:.2f} kg){info}")
-    await update.message.reply_text("\n".join(lines))
+    filtro = normalizar(context.args[0]) if context.args else "todos"
+    if filtro not in FILTROS_CATALOGO:
+        await update.message.reply_text("Uso: /itens [armas | consumiveis | municao]")
+        return
+    texto, teclado = render_cached("itens", (filtro, 0), snap.versao, lambda: render_itens(snap, filtro))
+    await update.message.reply_text(texto, reply_markup=teclado)
+
+async def itens_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    try:
+        _, filtro, versao, ini = query.data.split("_", 3)
+        versao, ini = int(versao), int(ini)
+    except ValueError:
+        return
+    if filtro not in FILTROS_CATALOGO:
+        return
+    snap = await catalogo()
+    if versao != snap.versao:
+        # O catálogo mudou desde que a página foi montada: as posições antigas não valem mais
+        ini = 0
+    texto, teclado = render_cached("itens", (filtro, ini), snap.versao,
+                                   lambda: render_itens(snap, filtro, ini))
+    try:
+        await query.edit_message_text(texto, reply_markup=teclado)
+    except Exception as e:
+        # Clique na página que já está aberta: o Telegram recusa a edição sem mudanças
+        logger.debug(f"/itens sem alteração: {e}")
 
 async def additem(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not anti_spam(update.effective_user.id):
@@ -934,7 +2234,7 @@ async def additem(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not peso:
         await update.message.reply_text("❌ Peso inválido. Use algo como 2,5")
         return
-    add_catalog_item(nome, peso)
+    await db(add_catalog_item, nome, peso)
     await update.message.reply_text(f"✅ Item '{nome}' adicionado ao catálogo com {peso:.2f} kg.")
     
 async def addconsumivel(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -982,7 +2282,7 @@ async def receber_tipo_consumivel(update: Update, context: ContextTypes.DEFAULT_
         return
     data = context.user_data.pop('addconsumivel_pending')
     nome, peso, bonus, armas_compat = data['nome'], data['peso'], data['bonus'], data['armas_compat']
-    add_catalog_item(nome, peso, consumivel=True, bonus=bonus, tipo=tipo, armas_compat=armas_compat)
+    await db(add_catalog_item, nome, peso, consumivel=True, bonus=bonus, tipo=tipo, armas_compat=armas_compat)
     await update.message.reply_text(f"✅ Consumível '{nome}' adicionado ao catálogo com {peso:.2f} kg. Bônus: {bonus}, Tipo: {tipo}.")
 
 # ARMA: /addarma nome peso melee/range bonus [munição atual/max] (para range)
@@ -1009,7 +2309,7 @@ async def addarma(update: Update, context: ContextTypes.DEFAULT_TYPE):
             except:
                 await update.message.reply_text("Formato de munição inválido. Use 15/20.")
                 return
-    add_catalog_item(nome, peso, consumivel=False, bonus=0, tipo='', arma_tipo=arma_tipo, arma_bonus=arma_bonus, muni_atual=muni_atual, muni_max=muni_max)
+    await db(add_catalog_item, nome, peso, consumivel=False, bonus=0, tipo='', arma_tipo=arma_tipo, arma_bonus=arma_bonus, muni_atual=muni_atual, muni_max=muni_max)
     await update.message.reply_text(f"✅ Arma '{nome}' ({arma_tipo}) adicionada ao catálogo. Bônus: {arma_bonus}" + (f", munição: {muni_atual}/{muni_max}" if arma_tipo == 'range' else ""))
 
     
@@ -1025,7 +2325,7 @@ async def delitem(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Uso: /delitem NomeDoItem")
         return
     nome = " ".join(context.args)
-    ok = del_catalog_item(nome)
+    ok = await db(del_catalog_item, nome)
     if ok:
         await update.message.reply_text(f"🗑️ Item '{nome}' removido do catálogo.")
     else:
@@ -1045,15 +2345,17 @@ async def dar(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid_from = update.effective_user.id
     register_username(uid_from, update.effective_user.username, update.effective_user.first_name)
 
-    user_tag = context.args[0]
-    target_id = username_to_id(user_tag)
+    target_id, user_tag, n = await resolver_alvo(update.message, context.args)
     if not target_id:
         await update.message.reply_text("❌ Jogador não encontrado. Peça para a pessoa usar /start pelo menos uma vez.")
         return
 
     # Parse do item e quantidade
     qtd = 1
-    tail = context.args[1:]
+    tail = context.args[n:]
+    if not tail:
+        await update.message.reply_text("Uso: /dar @jogador Nome do item xquantidade (opcional)")
+        return
     if len(tail) >= 2 and tail[-2].lower() == 'x' and tail[-1].isdigit():
         qtd = int(tail[-1])
         item_input = " ".join(tail[:-2])
@@ -1068,37 +2370,35 @@ async def dar(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Checa item no inventário
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute(
-        "SELECT nome, peso, quantidade FROM inventario WHERE player_id=%s AND LOWER(nome)=LOWER(%s)",
-        (uid_from, item_input)
-    )
-    row = c.fetchone()
+    row = await db(get_inventory_item, uid_from, item_input)
 
     if row:
         item_nome, item_peso, qtd_doador = row
         if qtd > qtd_doador:
-            conn.close()
             await update.message.reply_text(f"❌ Quantidade indisponível. Você tem {qtd_doador}x '{item_nome}'.")
             return
     else:
+        def montar(nome):
+            return user_tag.split() + nome.split() + ["x", str(qtd)]
         if is_admin(uid_from):
-            item_info = get_catalog_item(item_input)
+            snap = await catalogo()
+            item_info = snap.get(item_input)
             if not item_info:
-                conn.close()
+                if await sugerir_nomes(update, "dar", item_input, snap.nomes, montar):
+                    return
                 await update.message.reply_text(f"❌ Item '{item_input}' não encontrado no catálogo.")
                 return
             item_nome = item_info["nome"]
             item_peso = item_info["peso"]
         else:
-            conn.close()
+            doador = await db(get_player, uid_from)
+            if doador and await sugerir_nomes(update, "dar", item_input, indice_inventario(doador), montar):
+                return
             await update.message.reply_text(f"❌ Você não possui '{item_input}' no seu inventário.")
             return
-    conn.close()
 
     # Checa sobrecarga do alvo, mas não cancela, só avisa
-    target_before = get_player(target_id)
+    target_before = await db(get_player, target_id)
     total_depois_target = peso_total(target_before) + item_peso * qtd
     aviso_sobrecarga = ""
     if total_depois_target > target_before['peso_max']:
@@ -1163,87 +2463,36 @@ async def transfer_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         item = transfer['item']
         qtd = transfer['qtd']
 
-        conn = get_conn()
-        c = conn.cursor()
-        try:
-            # Debita do doador
-            c.execute(
-                "SELECT quantidade, peso FROM inventario WHERE player_id=%s AND LOWER(nome)=LOWER(%s)",
-                (doador, item)
-            )
-            row = c.fetchone()
-
-            if row:
-                qtd_doador, peso_item = row
-                nova_qtd_doador = qtd_doador - qtd
-                if nova_qtd_doador <= 0:
-                    c.execute(
-                        "DELETE FROM inventario WHERE player_id=%s AND LOWER(nome)=LOWER(%s)",
-                        (doador, item)
-                    )
-                else:
-                    c.execute(
-                        "UPDATE inventario SET quantidade=%s WHERE player_id=%s AND LOWER(nome)=LOWER(%s)",
-                        (nova_qtd_doador, doador, item)
-                    )
-            else:
-                if is_admin(doador):
-                    item_info = get_catalog_item(item)
-                    if not item_info:
-                        conn.close()
-                        await query.edit_message_text("❌ Item não encontrado no catálogo.")
-                        TRANSFER_PENDING.pop(transfer_key, None)
-                        return
-                    peso_item = item_info["peso"]
-                else:
-                    conn.close()
-                    await query.edit_message_text("❌ O doador não tem mais o item.")
-                    TRANSFER_PENDING.pop(transfer_key, None)
-                    return
-
-            # SEMPRE stacka no inventário do alvo, vindo do catálogo ou não!
-            c.execute(
-                "SELECT quantidade FROM inventario WHERE player_id=%s AND LOWER(nome)=LOWER(%s)",
-                (alvo, item)
-            )
-            row_tgt = c.fetchone()
-            if row_tgt:
-                nova_qtd_tgt = row_tgt[0] + qtd
-                c.execute(
-                    "UPDATE inventario SET quantidade=%s, peso=%s WHERE player_id=%s AND LOWER(nome)=LOWER(%s)",
-                    (nova_qtd_tgt, peso_item, alvo, item)
-                )
-            else:
-                c.execute(
-                    "INSERT INTO inventario(player_id, nome, peso, quantidade) VALUES(%s,%s,%s,%s)",
-                    (alvo, item, peso_item, qtd)
-                )
+        # Retira a pendência antes de ir ao banco: com updates concorrentes, um segundo clique
+        # não pode executar a mesma transferência de novo
+        if TRANSFER_PENDING.pop(transfer_key, None) is None:
+            return
 
-            conn.commit()
+        try:
+            status, resumo = await db(transferir_item, doador, alvo, item, qtd)
         except Exception as e:
-            conn.rollback()
-            conn.close()
             logger.error(f"Erro na transferência: {e}")
             await query.edit_message_text("❌ Ocorreu um erro ao transferir o item.")
-            TRANSFER_PENDING.pop(transfer_key, None)
             return
-        finally:
-            conn.close()
 
-        TRANSFER_PENDING.pop(transfer_key, None)
+        if status == "sem_catalogo":
+            await query.edit_message_text("❌ Item não encontrado no catálogo.")
+            return
+        if status == "sem_item":
+            await query.edit_message_text("❌ O doador não tem mais o item.")
+            return
+        if status == "sem_jogador":
+            await query.edit_message_text("❌ Jogador não encontrado. Os dois precisam ter usado /start.")
+            return
 
-        # Atualiza pesos e sobrecarga
-        giver_after = get_player(doador)
-        target_after = get_player(alvo)
-        total_giver = peso_total(giver_after)
-        total_target = peso_total(target_after)
-        excesso = max(0, total_target - target_after['peso_max'])
-        aviso_sobrecarga = f"\n  ⚠️ {target_after['nome']} está com sobrecarga de {excesso:.1f} kg!" if excesso else ""
+        # Pesos e sobrecarga já vêm calculados pela própria transferência
+        excesso = max(0, resumo['alvo_peso'] - resumo['alvo_peso_max'])
+        aviso_sobrecarga = f"\n  ⚠️ {resumo['alvo_nome']} está com sobrecarga de {excesso:.1f} kg!" if excesso else ""
 
         await query.edit_message_text(
             f"✅ Transferência confirmada! {item} x{qtd} entregue.\n"
-            f"📦 {giver_after['nome']}: {total_giver:.1f}/{giver_after['peso_max']} kg\n"
-            f"📦 {target_after['nome']}: {total_target:.1f}/{target_after['peso_max']} kg"
+            f"📦 {resumo['doador_nome']}: {resumo['doador_peso']:.1f}/{resumo['doador_peso_max']} kg\n"
+            f"📦 {resumo['alvo_nome']}: {resumo['alvo_peso']:.1f}/{resumo['alvo_peso_max']} kg"
             f"{aviso_sobrecarga}"
         )
 
@@ -1279,26 +2528,20 @@ async def abandonar(update: Update, context: ContextTypes.DEFAULT_TYPE):
         qtd = 1
         item_input = " ".join(args)
 
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute(
-        "SELECT nome, peso, quantidade FROM inventario WHERE player_id=%s AND LOWER(nome)=LOWER(%s)",
-        (uid, item_input.lower())
-    )
-    row = c.fetchone()
+    row = await db(get_inventory_item, uid, item_input)
     if not row:
-        conn.close()
+        player = await db(get_player, uid)
+        if player and await sugerir_nomes(update, "abandonar", item_input, indice_inventario(player),
+                                          lambda nome: nome.split() + ["x", str(qtd)]):
+            return
         await update.message.reply_text(f"❌ Você não possui '{item_input}' no seu inventário.")
         return
 
     item_nome, item_peso, qtd_inv = row
     if qtd < 1 or qtd > qtd_inv:
-        conn.close()
         await update.message.reply_text(f"❌ Quantidade inválida. Você tem {qtd_inv} '{item_nome}'.")
         return
 
-    conn.close()
-
     # Botões com uid do dono em ambos
     keyboard = [[
         InlineKeyboardButton("✅ Confirmar", callback_data=f"confirm_abandonar_{uid}_{quote(item_nome)}_{qtd}"),
@@ -1330,38 +2573,17 @@ async def callback_abandonar(update: Update, context: ContextTypes.DEFAULT_TYPE)
             await query.answer("Só o dono pode confirmar!", show_alert=True)
             return
 
-        conn = get_conn()
-        c = conn.cursor()
         try:
-            c.execute(
-                "SELECT quantidade FROM inventario WHERE player_id=%s AND LOWER(nome)=LOWER(%s)",
-                (uid, item_nome)
-            )
-            row = c.fetchone()
-            if not row:
-                await query.edit_message_text("❌ Item não encontrado no inventário.")
-                return
-            qtd_inv = row[0]
-            if qtd >= qtd_inv:
-                c.execute(
-                    "DELETE FROM inventario WHERE player_id=%s AND LOWER(nome)=LOWER(%s)",
-                    (uid, item_nome)
-                )
-            else:
-                c.execute(
-                    "UPDATE inventario SET quantidade=%s WHERE player_id=%s AND LOWER(nome)=LOWER(%s)",
-                    (qtd_inv - qtd, uid, item_nome)
-                )
-            conn.commit()
+            found = await db(abandonar_item, uid, item_nome, qtd)
         except Exception as e:
-            conn.rollback()
             logger.error(f"Erro ao abandonar item: {e}")
             await query.edit_message_text("❌ Erro ao abandonar o item.")
             return
-        finally:
-            conn.close()
+        if not found:
+            await query.edit_message_text("❌ Quantidade indisponível ou item não está mais no inventário.")
+            return
 
-        jogador = get_player(uid)
+        jogador = await db(get_player, uid)
         total_peso = peso_total(jogador)
 
         await query.edit_message_text(
@@ -1395,22 +2617,21 @@ async def recarregar(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     uid = update.effective_user.id
     arma_nome = " ".join(context.args).strip()
-    arma_obj = get_catalog_item(arma_nome)
+    snap = await catalogo()
+    arma_obj = snap.get(arma_nome)
     if not arma_obj or arma_obj['arma_tipo'] != 'range':
+        if not arma_obj and await sugerir_nomes(update, "recarregar", arma_nome, snap.nomes, str.split,
+                                                filtro=lambda nome: snap.get(nome)['arma_tipo'] == 'range'):
+            return
         await update.message.reply_text("❌ Arma não encontrada ou não é do tipo range.")
         return
+    arma_inv = next((i for i in ((await db(get_player, uid)) or {}).get("inventario", [])
+                     if normalizar(i['nome']) == normalizar(arma_obj['nome'])), None)
+    if not arma_inv:
+        await update.message.reply_text(f"❌ Você não possui '{arma_obj['nome']}' no inventário.")
+        return
     # Verifica munição compatível no inventário
-    municoes_disponiveis = []
-    for row in list_catalog():
-        nome, peso, consumivel, bonus, tipo, arma_tipo, arma_bonus, muni_atual, muni_max, armas_compat = row
-        if tipo == 'municao' and consumivel and armas_compat:
-            armas = [x.strip().lower() for x in armas_compat.split(',')]
-            if arma_obj['nome'].lower() in armas:
-                # Verifica se tem no inventário
-                inv = get_player(uid)['inventario']
-                for i in inv:
-                    if i['nome'].lower() == nome.lower() and i['quantidade'] > 0:
-                        municoes_disponiveis.append((nome, i['quantidade']))
+    municoes_disponiveis = await db(municoes_compativeis, uid, arma_obj['nome'])
     if not municoes_disponiveis:
         await update.message.reply_text("❌ Você não possui munição compatível para essa arma.")
         return
@@ -1428,7 +2649,8 @@ async def callback_recarregar(update: Update, context: ContextTypes.DEFAULT_TYPE
     query = update.callback_query
     data = query.data
     if data.startswith("confirm_recarregar_"):
-        _, uid_str, arma_nome, mun_nome = data.split("_", 3)
+        # confirm_recarregar_<uid>_<arma>_<munição>
+        _, _, uid_str, arma_nome, mun_nome = data.split("_", 4)
         uid = int(uid_str)
         arma_nome = unquote(arma_nome)
         mun_nome = unquote(mun_nome)
@@ -1436,28 +2658,14 @@ async def callback_recarregar(update: Update, context: ContextTypes.DEFAULT_TYPE
         if query.from_user.id != uid:
             await query.answer("Só o dono pode confirmar!", show_alert=True)
             return
-        # Checa inventário
-        conn = get_conn()
-        c = conn.cursor()
-        c.execute("SELECT quantidade FROM inventario WHERE player_id=%s AND LOWER(nome)=LOWER(%s)", (uid, mun_nome))
-        row = c.fetchone()
-        if not row or row[0] < 1:
-            conn.close()
+        status, antes, muni_max = await db(recarregar_arma, uid, arma_nome, mun_nome)
+        if status == "sem_arma":
+            await query.edit_message_text(f"❌ '{arma_nome}' não está mais no seu inventário.")
+            return
+        if status == "sem_municao":
             await query.edit_message_text("❌ Munição não encontrada.")
             return
-        # Consome munição
-        nova = row[0] - 1
-        if nova <= 0:
-            c.execute("DELETE FROM inventario WHERE player_id=%s AND LOWER(nome)=LOWER(%s)", (uid, mun_nome))
-        else:
-            c.execute("UPDATE inventario SET quantidade=%s WHERE player_id=%s AND LOWER(nome)=LOWER(%s)", (nova, uid, mun_nome))
-        # Atualiza munição da arma no catálogo
-        arma_obj = get_catalog_item(arma_nome)
-        muni_max = arma_obj['muni_max']
-        c.execute("UPDATE catalogo SET muni_atual=%s WHERE LOWER(nome)=LOWER(%s)", (muni_max, arma_nome))
-        conn.commit()
-        conn.close()
-        await query.edit_message_text(f"Munição '{mun_nome}' consumida, '{arma_nome}' recarregada! {arma_obj['muni_atual']}/{muni_max} → {muni_max}/{muni_max}")
+        await query.edit_message_text(f"Munição '{mun_nome}' consumida, '{arma_nome}' recarregada! {antes}/{muni_max} → {muni_max}/{muni_max}")
     elif data.startswith("cancel_recarregar_"):
         await query.edit_message_text("❌ Recarga cancelada.")
     else:
@@ -1478,21 +2686,20 @@ async def consumir(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         qtd = 1
         item_input = " ".join(args)
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute(
-        "SELECT nome, quantidade FROM inventario WHERE player_id=%s AND LOWER(nome)=LOWER(%s)",
-        (uid, item_input.lower())
-    )
-    row = c.fetchone()
-    conn.close()
+    row = await db(get_inventory_item, uid, item_input)
     if not row:
+        player = await db(get_player, uid)
+        snap = await catalogo()
+        if player and await sugerir_nomes(update, "consumir", item_input, indice_inventario(player),
+                                          lambda nome: nome.split() + ["x", str(qtd)],
+                                          filtro=lambda nome: consumivel_direto(snap.get(nome))):
+            return
         await update.message.reply_text(f"❌ Você não possui '{item_input}' no seu inventário.")
         return
-    item_nome, qtd_inv = row
-    cat = get_catalog_item(item_nome)
+    item_nome, _, qtd_inv = row
+    cat = (await catalogo()).get(item_nome)
     # Só permite consumir se for consumível sem bônus ou tipo
-    if not cat or not cat.get("consumivel") or cat.get("bonus") or (cat.get("tipo") not in ("nenhum", None, "")):
+    if not consumivel_direto(cat):
         await update.message.reply_text(f"❌ '{item_nome}' não pode ser consumido diretamente.")
         return
     if qtd < 1 or qtd > qtd_inv:
@@ -1524,35 +2731,13 @@ async def callback_consumir(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.answer("Só o dono pode confirmar!", show_alert=True)
             return
 
-        # Confirma no inventário
-        conn = get_conn()
-        c = conn.cursor()
-        c.execute("SELECT quantidade FROM inventario WHERE player_id=%s AND LOWER(nome)=LOWER(%s)", (uid, item_nome))
-        row = c.fetchone()
-        if not row or row[0] < qtd:
-            conn.close()
+        status = await db(consumir_item, uid, item_nome, qtd)
+        if status == "sem_item":
             await query.edit_message_text(f"❌ Quantidade inválida ou item não está mais no inventário.")
             return
-
-        # Checa se continua sendo consumível no catálogo
-        cat = get_catalog_item(item_nome)
-        if not cat or not cat.get("consumivel"):
-            conn.close()
+        if status == "nao_consumivel":
             await query.edit_message_text(f"❌ '{item_nome}' não é mais um item consumível.")
             return
-
-        if qtd == row[0]:
-            c.execute(
-                "DELETE FROM inventario WHERE player_id=%s AND LOWER(nome)=LOWER(%s)",
-                (uid, item_nome)
-            )
-        else:
-            c.execute(
-                "UPDATE inventario SET quantidade=%s WHERE player_id=%s AND LOWER(nome)=LOWER(%s)",
-                (row[0] - qtd, uid, item_nome)
-            )
-        conn.commit()
-        conn.close()
         await query.edit_message_text(f"🍽️ Você consumiu '{item_nome}' x{qtd}!")
 
     elif data.startswith("cancel_consumir_"):
@@ -1589,33 +2774,42 @@ async def dano(update: Update, context: ContextTypes.DEFAULT_TYPE):
     responder_em_si = True
     pericia_usada = None
     item_obj = None
+    pente = None
 
     # Parse alvo e extra
     args = context.args[1:]
     if args:
-        if args[0].startswith('@'):
-            alvo_tag = args[0]
-            t = username_to_id(alvo_tag)
+        if args[0].startswith('@') or id_por_mencao(update.message, args)[0]:
+            t, alvo_tag, n = await resolver_alvo(update.message, args)
             if t:
                 alvo_id = t
                 responder_em_si = False
-            args = args[1:]
+            args = args[n:]
 
     # Parse pericia ou arma/consumivel
     if args:
         extra = " ".join(args)
         # Primeiro: verificar se é arma ou consumível no catálogo
-        item_obj = get_catalog_item(extra)
+        item_obj = (await catalogo()).get(extra)
         if item_obj:
             item_nome = item_obj['nome']
             # Se é arma
             if item_obj['arma_tipo']:
                 if item_obj['arma_tipo'] == 'melee':
                     pericia_usada = 'Luta'
-                    bonus_pericia = get_player(uid)['pericias'].get('Luta', 0)
+                    bonus_pericia = (await db(get_player, uid))['pericias'].get('Luta', 0)
                 elif item_obj['arma_tipo'] == 'range':
+                    # Atira com o pente da própria arma: sem a arma no inventário, não há disparo
+                    status, restante, maximo = await db(disparar_arma, uid, item_nome)
+                    if status == "sem_arma":
+                        await update.message.reply_text(f"❌ Você não tem '{item_nome}' no inventário.")
+                        return
+                    if status == "vazia":
+                        await update.message.reply_text(f"❌ '{item_nome}' está sem munição! Use /recarregar {item_nome}.")
+                        return
+                    pente = (restante, maximo)
                     pericia_usada = 'Pontaria'
-                    bonus_pericia = get_player(uid)['pericias'].get('Pontaria', 0)
+                    bonus_pericia = (await db(get_player, uid))['pericias'].get('Pontaria', 0)
                 bonus_arma = item_obj['arma_bonus']
             # Se é consumível de dano com bônus
             elif item_obj['consumivel'] and item_obj['bonus'] and item_obj['tipo'] == "dano":
@@ -1626,9 +2820,15 @@ async def dano(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             # Não é item, tenta pegar perícia/atributo
             extra_norm = normalizar(extra)
+            if extra_norm not in ["forca", "luta", "pontaria"]:
+                snap = await catalogo()
+                prefixo = context.args[:len(context.args) - len(args)]
+                if await sugerir_nomes(update, "dano", extra, snap.nomes, lambda nome: prefixo + nome.split(),
+                                       filtro=lambda nome: serve_para_dano(snap.get(nome))):
+                    return
             if extra_norm in ["forca", "luta", "pontaria"]:
                 pericia_usada = ATRIBUTOS_NORMAL.get(extra_norm) or PERICIAS_NORMAL.get(extra_norm)
-                bonus_pericia = get_player(uid)['atributos'].get(pericia_usada, 0) if extra_norm == "forca" else get_player(uid)['pericias'].get(pericia_usada, 0)
+                bonus_pericia = (await db(get_player, uid))['atributos'].get(pericia_usada, 0) if extra_norm == "forca" else (await db(get_player, uid))['pericias'].get(pericia_usada, 0)
 
     # Monta texto de quem ataca quem
     if responder_em_si:
@@ -1649,20 +2849,18 @@ async def dano(update: Update, context: ContextTypes.DEFAULT_TYPE):
         msg += f"Bônus de arma: +{bonus_arma}\n"
     if bonus_consumivel:
         msg += f"Bônus de consumível: +{bonus_consumivel}\n"
+    if pente:
+        msg += f"Munição de {item_nome}: {pente[0]}/{pente[1]}\n"
     msg += f"Total: {total}\n"
 
-    alvo_player = get_player(alvo_id)
+    alvo_player = await db(get_player, alvo_id)
     if tipo in ("hp", "vida"):
-        before = alvo_player['hp']
-        after = max(0, before - total)
-        update_player_field(alvo_id, 'hp', after)
+        before, after = await db(ajustar_pontos, alvo_id, 'hp', 'dano', total)
         msg += f"{alvo_player['nome']}: HP {before} → {after}"
         if after == 0:
             msg += "\n💀 Entrou em coma! Use /coma."
     else:
-        before = alvo_player['sp']
-        after = max(0, before - total)
-        update_player_field(alvo_id, 'sp', after)
+        before, after = await db(ajustar_pontos, alvo_id, 'sp', 'dano', total)
         msg += f"{alvo_player['nome']}: SP {before} → {after}"
         if after == 0:
             trauma = random.choice(TRAUMAS)
@@ -1684,20 +2882,19 @@ async def cura(update: Update, context: ContextTypes.DEFAULT_TYPE):
     alvo_id = uid
     alvo_tag = mention(update.effective_user)
     responder_em_si = True
-    if args[0].startswith('@'):
-        alvo_tag = args[0]
-        t = username_to_id(alvo_tag)
+    if args[0].startswith('@') or id_por_mencao(update.message, args)[0]:
+        t, alvo_tag, n = await resolver_alvo(update.message, args)
         if t:
             alvo_id = t
             responder_em_si = False
-        args = args[1:]
+        args = args[n:]
     if not args:
         await update.message.reply_text("❌ Falta nome do kit ou consumível.")
         return
     kit_nome = " ".join(args).strip()
-    kit_obj = get_catalog_item(kit_nome)
+    kit_obj = (await catalogo()).get(kit_nome)
     bonus_kit = 0
-    bonus_med = get_player(uid)['pericias'].get('Medicina', 0)
+    bonus_med = (await db(get_player, uid))['pericias'].get('Medicina', 0)
     tipo_item = ''
     if kit_obj:
         if kit_obj['arma_tipo']:
@@ -1719,33 +2916,26 @@ async def cura(update: Update, context: ContextTypes.DEFAULT_TYPE):
         key = kit_nome.lower()
         bonus_kit = KIT_BONUS.get(key)
         if bonus_kit is None:
+            player = await db(get_player, uid)
+            snap = await catalogo()
+            prefixo = context.args[:len(context.args) - len(args)]
+            if player and await sugerir_nomes(update, "cura", kit_nome, indice_inventario(player),
+                                              lambda nome: prefixo + nome.split(),
+                                              filtro=lambda nome: serve_para_cura(snap.get(nome), nome)):
+                return
             await update.message.reply_text("❌ Kit inválido. Use: Kit Básico, Kit Intermediário ou Kit Avançado, ou item de cura.")
             return
 
     # Consome item do inventário
-    conn = get_conn()
-    c = conn.cursor()
     inv_nome = kit_obj['nome'] if kit_obj else kit_nome
-    c.execute("SELECT quantidade,peso FROM inventario WHERE player_id=%s AND LOWER(nome)=LOWER(%s)", (uid, inv_nome))
-    row = c.fetchone()
-    if not row or row[0] <= 0:
+    if not await db(adjust_item_quantity, uid, inv_nome, -1):
         await update.message.reply_text(f"❌ Você não possui '{kit_nome}' no inventário.")
-        conn.close()
         return
-    nova = row[0] - 1
-    if nova <= 0:
-        c.execute("DELETE FROM inventario WHERE player_id=%s AND LOWER(nome)=LOWER(%s)", (uid, inv_nome))
-    else:
-        c.execute("UPDATE inventario SET quantidade=%s WHERE player_id=%s AND LOWER(nome)=LOWER(%s)", (nova, uid, inv_nome))
-    conn.commit()
-    conn.close()
 
     dado = random.randint(1, 6)
     total = dado + bonus_kit + bonus_med
-    alvo = get_player(alvo_id)
-    before = alvo['hp']
-    after = min(alvo['hp_max'], before + total)
-    update_player_field(alvo_id, 'hp', after)
+    alvo = await db(get_player, alvo_id)
+    before, after = await db(ajustar_pontos, alvo_id, 'hp', 'cura', total)
 
     if responder_em_si:
         texto_acao = f"@{update.effective_user.username} aplicou cura em si mesmo"
@@ -1772,8 +2962,7 @@ async def terapia(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(context.args) < 1:
         await update.message.reply_text("Uso: /terapia @jogador")
         return
-    alvo_tag = context.args[0]
-    alvo_id = username_to_id(alvo_tag)
+    alvo_id, alvo_tag, _ = await resolver_alvo(update.message, context.args)
     if not alvo_id:
         await update.message.reply_text("❌ Jogador não encontrado. Peça para a pessoa usar /start.")
         return
@@ -1781,15 +2970,13 @@ async def terapia(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Terapia só pode ser aplicada em outra pessoa.")
         return
 
-    healer = get_player(uid)
+    healer = await db(get_player, uid)
     bonus_pers = healer['pericias'].get('Persuasão', 0)
     dado = random.randint(1, 6)
     total = dado + bonus_pers
 
-    alvo = get_player(alvo_id)
-    before = alvo['sp']
-    after = min(alvo['sp_max'], before + total)
-    update_player_field(alvo_id, 'sp', after)
+    alvo = await db(get_player, alvo_id)
+    before, after = await db(ajustar_pontos, alvo_id, 'sp', 'cura', total)
 
     msg = (
         f"🎲 {mention(update.effective_user)} aplicou uma sessão de terapia em {alvo_tag}!\n"
@@ -1808,7 +2995,7 @@ async def coma(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
     register_username(uid, update.effective_user.username, update.effective_user.first_name)
 
-    player = get_player(uid)
+    player = await db(get_player, uid)
     if not player:
         await update.message.reply_text("Use /start primeiro!")
         return
@@ -1818,7 +3005,7 @@ async def coma(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     dados = roll_dados(4, 6)
     soma = sum(dados)
-    bonus_ajuda = pop_coma_bonus(uid)
+    bonus_ajuda = await db(pop_coma_bonus, uid)
     total = soma + bonus_ajuda
 
     # Definir resultado narrativo
@@ -1827,12 +3014,12 @@ async def coma(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif total <= 12:
         status = "💀 Continua em coma. O corpo permanece inconsciente, lutando por cada respiração."
     elif total <= 19:
-        update_player_field(uid, 'hp', 1)
+        await db(update_player_field, uid, 'hp', 1)
         status = "🌅 Você desperta, fraco e atordoado. HP agora: 1."
     else:  # 20+
         extra_hp = random.randint(2, 5)
         new_hp = min(player['hp_max'], extra_hp)
-        update_player_field(uid, 'hp', new_hp)
+        await db(update_player_field, uid, 'hp', new_hp)
         status = f"🌟 Sucesso crítico! Um milagre: você acorda com {new_hp} HP, mais forte que antes!"
 
     await update.message.reply_text(
@@ -1855,20 +3042,22 @@ async def ajudar(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(context.args) < 2:
         await update.message.reply_text("Uso: /ajudar @jogador NomeDoKitOuConsumivel")
         return
-    alvo_tag = context.args[0]
-    alvo_id = username_to_id(alvo_tag)
+    alvo_id, alvo_tag, n = await resolver_alvo(update.message, context.args)
     if not alvo_id:
         await update.message.reply_text("❌ Jogador não encontrado. Peça para a pessoa usar /start.")
         return
+    if n >= len(context.args):
+        await update.message.reply_text("Uso: /ajudar @jogador NomeDoKitOuConsumivel")
+        return
 
-    alvo = get_player(alvo_id)
+    alvo = await db(get_player, alvo_id)
     if alvo['hp'] > 0:
         await update.message.reply_text("❌ O alvo não está em coma no momento.")
         return
 
-    item_nome = " ".join(context.args[1:]).strip()
+    item_nome = " ".join(context.args[n:]).strip()
     # Tenta buscar no catálogo
-    cat = get_catalog_item(item_nome)
+    cat = (await catalogo()).get(item_nome)
     bonus = 0
     tipo_item = ''
     if cat:
@@ -1897,29 +3086,23 @@ async def ajudar(update: Update, context: ContextTypes.DEFAULT_TYPE):
         key = item_nome.lower()
         bonus = KIT_BONUS.get(key)
         if bonus is None:
+            player = await db(get_player, uid)
+            snap = await catalogo()
+            if player and await sugerir_nomes(update, "ajudar", item_nome, indice_inventario(player),
+                                              lambda nome: alvo_tag.split() + nome.split(),
+                                              filtro=lambda nome: serve_para_cura(snap.get(nome), nome)):
+                return
             await update.message.reply_text("❌ Item inválido. Use um kit médico (Básico/Intermediário/Avançado) ou um consumível de cura.")
             return
         tipo_item = "kit"
 
     # Consome item do inventário
-    conn = get_conn()
-    c = conn.cursor()
     inv_nome = cat['nome'] if cat else item_nome
-    c.execute("SELECT quantidade FROM inventario WHERE player_id=%s AND LOWER(nome)=LOWER(%s)", (uid, inv_nome))
-    row = c.fetchone()
-    if not row or row[0] <= 0:
+    if not await db(adjust_item_quantity, uid, inv_nome, -1):
         await update.message.reply_text(f"❌ Você não possui '{item_nome}' no inventário.")
-        conn.close()
         return
-    nova = row[0] - 1
-    if nova <= 0:
-        c.execute("DELETE FROM inventario WHERE player_id=%s AND LOWER(nome)=LOWER(%s)", (uid, inv_nome))
-    else:
-        c.execute("UPDATE inventario SET quantidade=%s WHERE player_id=%s AND LOWER(nome)=LOWER(%s)", (nova, uid, inv_nome))
-    conn.commit()
-    conn.close()
 
-    add_coma_bonus(alvo_id, bonus)
+    await db(add_coma_bonus, alvo_id, bonus)
     await update.message.reply_text(
         f"🤝 {mention(update.effective_user)} usou '{item_nome}' em {alvo_tag}!\nBônus aplicado ao próximo teste de coma: +{bonus}."
     )
@@ -1931,7 +3114,7 @@ async def roll(update: Update, context: ContextTypes.DEFAULT_TYPE, consumir_rero
 
     uid = update.effective_user.id
     register_username(uid, update.effective_user.username, update.effective_user.first_name)
-    player = get_player(uid)
+    player = await db(get_player, uid)
     if not player or len(context.args) < 1:
         await update.message.reply_text("Uso: /roll nome_da_pericia_ou_atributo OU /roll d20+2")
         return False
@@ -1987,12 +3170,12 @@ async def roll(update: Update, context: ContextTypes.DEFAULT_TYPE, consumir_rero
 
 async def reroll(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    player = get_player(uid)
+    player = await db(get_player, uid)
     if not player:
         await update.message.reply_text("Use /start primeiro!")
         return
 
-    if player['rerolls'] <= 0:
+    if rerolls_disponiveis(player) <= 0:
         await update.message.reply_text("❌ Você não tem rerolls disponíveis hoje!")
         return
 
@@ -2005,8 +3188,10 @@ async def reroll(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if ok:
         # Diminui 1 reroll
-        novos_rerolls = player['rerolls'] - 1
-        update_player_field(uid, 'rerolls', novos_rerolls)
+        novos_rerolls = await db(usar_reroll, uid)
+        if novos_rerolls is None:
+            await update.message.reply_text("❌ Você não tem rerolls disponíveis hoje!")
+            return
 
         await update.message.reply_text(
             f"🔄 Reroll usado! Rerolls restantes: {novos_rerolls}"
@@ -2015,20 +3200,10 @@ async def reroll(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def xp(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
     semana = semana_atual()
-    conn = get_conn()
-    c = conn.cursor()
-    # XP total + streak
-    c.execute("SELECT xp_total, streak_atual FROM xp_semana WHERE player_id=%s AND semana_inicio=%s", (uid, semana))
-    row = c.fetchone()
-    xp_total = row[0] if row else 0
-    streak = row[1] if row else 0
-    # Turnos por dia
-    c.execute("SELECT data, caracteres, mencoes FROM turnos WHERE player_id=%s AND data >= %s ORDER BY data", (uid, semana))
-    dias = c.fetchall()
+    xp_total, streak, dias = await db(get_xp_semana, uid, semana)
     lines = [f"📊 <b>Seu XP semanal:</b> {xp_total} XP", f"Streak atual: {streak} dias"]
     for d in dias:
-        data, chars, menc = d
-        xp_chars = xp_por_caracteres(chars)
+        data, chars, menc, xp_chars = d
         lines.append(f"📅 {data.strftime('%d/%m')}: {xp_chars} XP ({chars} caracteres)" + (f" | Menções: {menc}" if menc else ""))
     await update.message.reply_text("\n".join(lines), parse_mode="HTML")
 
@@ -2043,62 +3218,252 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.answer()
 
 async def ranking(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    semana = semana_atual()
-    conn = get_conn()
-    c = conn.cursor()
+    uid = update.effective_user.id
+    await garantir_ranking()
+    text = render_cached("ranking", uid, (LEADERBOARD.semana, LEADERBOARD.versao), lambda: render_ranking(uid))
 
-    # Top 10 da semana
-    c.execute("""
-        SELECT player_id, xp_total, streak_atual
-        FROM xp_semana
-        WHERE semana_inicio=%s
-        ORDER BY xp_total DESC
-        LIMIT 10
-    """, (semana,))
-    top = c.fetchall()
-
-    # Ranking completo para achar posição do player
-    c.execute("""
-        SELECT player_id, xp_total, streak_atual
-        FROM xp_semana
-        WHERE semana_inicio=%s
-        ORDER BY xp_total DESC
-    """, (semana,))
-    ranking_full = c.fetchall()
-    conn.close()
+    # Responde certo dependendo da origem
+    if update.message:  # comando /ranking
+        await update.message.reply_text(text, parse_mode="HTML")
+    elif update.callback_query:  # botão
+        await update.callback_query.message.reply_text(text, parse_mode="HTML")
 
-    players = {pid: get_player(pid) for pid, _, _ in ranking_full}
+# ================== SUGESTÕES DE NOMES ==================
+# Nome de item sem correspondência exata: em vez de só dar erro, oferece botões com os
+# nomes mais parecidos. O clique refaz o mesmo comando com o nome escolhido.
+_SUGESTAO_SEQ = itertools.count(1)
 
+async def sugerir_nomes(update, comando, entrada, indice, montar_args, filtro=None):
+    """Responde "Você quis dizer…" com botões; False se não houver nada parecido.
+    montar_args(nome) devolve os argumentos do comando com o nome sugerido."""
+    nomes = indice.sugerir(entrada, filtro=filtro)
+    if not nomes:
+        return False
     uid = update.effective_user.id
-    lines = ["🏆 <b>Ranking semanal (Top 10)</b>"]
-    medals = ['🥇', '🥈', '🥉']
+    chave = f"{uid}_{next(_SUGESTAO_SEQ)}"
+    SUGESTOES_PENDENTES[chave] = {
+        "comando": comando,
+        "uid": uid,
+        "nomes": nomes,
+        "args": [montar_args(n) for n in nomes],
+        "expires": time.time() + 120,
+    }
+    keyboard = [[InlineKeyboardButton(n, callback_data=f"sug_{chave}_{i}")] for i, n in enumerate(nomes)]
+    await update.message.reply_text(f"❓ '{entrada}' não encontrado. Você quis dizer:",
+                                    reply_markup=InlineKeyboardMarkup(keyboard))
+    return True
 
-    for idx, (pid, xp, streak) in enumerate(top):
-        nome = players[pid]['nome'] if players.get(pid) else f"ID:{pid}"
-        medal = medals[idx] if idx < len(medals) else f"{idx+1}."
-        highlight = " <b>(Você)</b>" if pid == uid else ""
-        lines.append(f"{medal} <b>{nome}</b> — {xp} XP | 🔥 Streak: {streak}d{highlight}")
+class _UpdateSugestao:
+    """O update original refeito a partir do clique: mesmo usuário, respostas na mensagem das sugestões."""
+    def __init__(self, query):
+        self.effective_user = query.from_user
+        self.message = query.message
+        self.effective_chat = query.message.chat
+        self.callback_query = None
 
-    if not top:
-        lines.append("Ninguém tem XP ainda nesta semana!")
+async def sugestao_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    try:
+        _, uid_str, seq, idx = query.data.split("_")
+        chave, idx = f"{uid_str}_{seq}", int(idx)
+    except ValueError:
+        await query.answer("Callback inválido.", show_alert=True)
+        return
+    pendente = SUGESTOES_PENDENTES.get(chave)
+    if not pendente or time.time() > pendente["expires"]:
+        SUGESTOES_PENDENTES.pop(chave, None)
+        await query.answer()
+        await query.edit_message_text("❌ Sugestão expirada. Envie o comando de novo.")
+        return
+    if query.from_user.id != pendente["uid"]:
+        await query.answer("Só quem usou o comando pode escolher!", show_alert=True)
+        return
+    # Retira antes de executar: dois cliques não repetem o comando
+    if SUGESTOES_PENDENTES.pop(chave, None) is None:
+        return
+    await query.answer()
+    await query.edit_message_text(f"🔎 {pendente['nomes'][idx]}")
+    comandos = {"dar": dar, "abandonar": abandonar, "consumir": consumir, "recarregar": recarregar,
+                "dano": dano, "cura": cura, "ajudar": ajudar}
+    context.args = pendente["args"][idx]
+    await comandos[pendente["comando"]](_UpdateSugestao(query), context)
+
+# ================== NOTIFICAÇÕES DO BANCO ==================
+# Conexão dedicada (fora do pool) em LISTEN; o event loop acorda quando chega um NOTIFY.
+LISTEN_RETRY = 30
+_LISTEN_CONN = None
+
+def _conectar_listen():
+    conn = psycopg2.connect(DATABASE_URL)
+    conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    conn.cursor().execute("LISTEN catalogo")
+    return conn
+
+def _ao_notificar(loop, fd):
+    try:
+        _LISTEN_CONN.poll()
+    except psycopg2.Error as e:
+        logger.warning(f"Conexão LISTEN caiu, reconectando em {LISTEN_RETRY}s: {e}")
+        loop.remove_reader(fd)
+        try:
+            _LISTEN_CONN.close()
+        except Exception:
+            pass
+        loop.call_later(LISTEN_RETRY, lambda: loop.create_task(iniciar_listen()))
+        return
+    if _LISTEN_CONN.notifies:
+        _LISTEN_CONN.notifies.clear()
+        invalidate_catalog()
+
+async def iniciar_listen():
+    global _LISTEN_CONN
+    loop = asyncio.get_running_loop()
+    try:
+        _LISTEN_CONN = await db(_conectar_listen)
+    except psycopg2.Error as e:
+        logger.warning(f"Falha ao abrir conexão LISTEN, tentando em {LISTEN_RETRY}s: {e}")
+        loop.call_later(LISTEN_RETRY, lambda: loop.create_task(iniciar_listen()))
+        return
+    # Alterações feitas enquanto estávamos desconectados não geraram aviso
+    invalidate_catalog()
+    fd = _LISTEN_CONN.fileno()
+    loop.add_reader(fd, _ao_notificar, loop, fd)
+
+# ================== AGENDADOR ==================
+# Tarefas periódicas como tasks do próprio event loop (nada de threads dormindo): cada uma
+# calcula o próximo horário, dorme até lá e registra tempo/erros em TAREFAS_STATS (/metrics).
+# As semanais guardam a última execução na tabela agendador; se o bot estava fora do ar no
+# horário, rodam assim que ele volta, e se falham são repetidas a cada TAREFA_RETRY segundos.
+TAREFAS_STATS = {}
+TAREFAS_STATS_LOCK = threading.Lock()
+
+class Tarefa:
+    def __init__(self, nome, acao, intervalo=None, semanal=None):
+        self.nome = nome
+        self.acao = acao            # async acao(app)
+        self.intervalo = intervalo  # segundos entre execuções, ou
+        self.semanal = semanal      # (dia da semana, hora): 0 = segunda
+
+    def anterior(self, agora):
+        """Último horário agendado até agora (só semanais)."""
+        dia, hora = self.semanal
+        t = agora.replace(hour=hora, minute=0, second=0, microsecond=0) - timedelta(days=(agora.weekday() - dia) % 7)
+        return t if t <= agora else t - timedelta(days=7)
+
+    def proxima(self, agora):
+        if self.semanal:
+            return self.anterior(agora) + timedelta(days=7)
+        return agora + timedelta(seconds=self.intervalo)
+
+def ultima_execucao(nome):
+    conn = get_conn()
+    try:
+        c = conn.cursor()
+        c.execute("SELECT ultima_execucao FROM agendador WHERE tarefa=%s", (nome,))
+        row = c.fetchone()
+    finally:
+        conn.close()
+    return row[0] if row else None
 
-    # Se o jogador não estiver no Top 10, mostra posição separada
-    if uid not in [pid for pid, _, _ in top]:
-        for pos, (pid, xp, streak) in enumerate(ranking_full, start=1):
-            if pid == uid:
-                nome = players[pid]['nome'] if players.get(pid) else f"ID:{pid}"
-                lines.append(
-                    f"\n➡️ Sua posição: {pos}º — <b>{nome}</b> — {xp} XP | 🔥 Streak: {streak}d"
-                )
-                break
+def gravar_execucao(nome, quando):
+    conn = get_conn()
+    try:
+        c = conn.cursor()
+        c.execute("INSERT INTO agendador(tarefa, ultima_execucao) VALUES (%s, %s) "
+                  "ON CONFLICT (tarefa) DO UPDATE SET ultima_execucao = EXCLUDED.ultima_execucao", (nome, quando))
+        conn.commit()
+    finally:
+        conn.close()
 
-    text = "\n".join(lines)
+async def _executar_tarefa(tarefa, app):
+    """Roda a tarefa uma vez e registra as métricas; retorna False se ela falhou."""
+    inicio = datetime.now()
+    t0 = time.perf_counter()
+    erro = None
+    try:
+        await tarefa.acao(app)
+        if tarefa.semanal:
+            await db(gravar_execucao, tarefa.nome, inicio)
+    except Exception as e:
+        erro = e
+        logger.error(f"Erro na tarefa {tarefa.nome}: {e}")
+    ms = 1000 * (time.perf_counter() - t0)
+    with TAREFAS_STATS_LOCK:
+        st = TAREFAS_STATS.setdefault(tarefa.nome, {"execucoes": 0, "erros": 0, "tempo_total_ms": 0.0})
+        st["execucoes"] += 1
+        st["erros"] += erro is not None
+        st["tempo_total_ms"] += ms
+        st["ultima_ms"] = round(ms, 2)
+        st["ultima_execucao"] = inicio.isoformat(timespec="seconds")
+        st["ultimo_erro"] = str(erro) if erro else st.get("ultimo_erro")
+    return erro is None
+
+async def _rodar_tarefa(tarefa, app):
+    pendente = False  # semanal que falhou: tenta de novo em TAREFA_RETRY, não daqui a 7 dias
+    if tarefa.semanal:
+        # Recupera a execução perdida enquanto o bot estava desligado
+        try:
+            ultima = await db(ultima_execucao, tarefa.nome)
+        except Exception as e:
+            logger.error(f"Erro ao ler o agendador ({tarefa.nome}): {e}")
+            ultima = datetime.now()
+        if ultima is None:
+            # Primeira vez: só marca o ponto de partida, sem "recuperar" semanas de antes do agendador
+            try:
+                await db(gravar_execucao, tarefa.nome, datetime.now())
+            except Exception as e:
+                logger.error(f"Erro ao gravar o agendador ({tarefa.nome}): {e}")
+        elif ultima < tarefa.anterior(datetime.now()):
+            logger.info(f"⏰ Recuperando tarefa atrasada: {tarefa.nome}")
+            pendente = not await _executar_tarefa(tarefa, app)
+    while True:
+        if pendente:
+            proxima = datetime.now() + timedelta(seconds=TAREFA_RETRY)
+        else:
+            proxima = tarefa.proxima(datetime.now())
+        with TAREFAS_STATS_LOCK:
+            TAREFAS_STATS.setdefault(tarefa.nome, {"execucoes": 0, "erros": 0, "tempo_total_ms": 0.0})["proxima"] = \
+                proxima.isoformat(timespec="seconds")
+        await asyncio.sleep(max(0.0, (proxima - datetime.now()).total_seconds()))
+        ok = await _executar_tarefa(tarefa, app)
+        pendente = bool(tarefa.semanal) and not ok
+
+async def _limpar_pendentes(app):
+    cleanup_expired_transfers()
+
+async def _gravar_usernames(app):
+    await db(flush_usernames)
+
+async def _garantir_particoes(app):
+    await db(garantir_particoes_atuais)
+
+TAREFAS = [
+    Tarefa("limpar_pendentes", _limpar_pendentes, intervalo=300),
+    Tarefa("gravar_usernames", _gravar_usernames, intervalo=USERNAME_FLUSH),
+    Tarefa("garantir_particoes", _garantir_particoes, intervalo=3600),
+    Tarefa("ranking_semanal", ranking_semanal, semanal=(0, 6)),
+]
 
-    # Responde certo dependendo da origem
-    if update.message:  # comando /ranking
-        await update.message.reply_text(text, parse_mode="HTML")
-    elif update.callback_query:  # botão
-        await update.callback_query.message.reply_text(text, parse_mode="HTML")
+def tarefas_stats():
+    with TAREFAS_STATS_LOCK:
+        stats = {nome: dict(st) for nome, st in TAREFAS_STATS.items()}
+    for st in stats.values():
+        st["media_ms"] = round(st.pop("tempo_total_ms") / max(1, st["execucoes"]), 2)
+    return stats
+
+async def post_init(app: Application):
+    await iniciar_listen()
+    await db(carregar_usernames)
+    await db(carregar_ranking)
+    app.bot_data["tarefas"] = [asyncio.create_task(_rodar_tarefa(t, app)) for t in TAREFAS]
+
+async def post_shutdown(app: Application):
+    for tarefa in app.bot_data.pop("tarefas", []):
+        tarefa.cancel()
+    try:
+        await db(flush_usernames)
+    except Exception as e:
+        logger.error(f"Erro ao gravar usernames no desligamento: {e}")
 
 # ================== FLASK ==================
 flask_app = Flask(__name__)
@@ -2107,22 +3472,28 @@ flask_app = Flask(__name__)
 def home():
     return "Bot online!"
 
+@flask_app.route("/metrics")
+def metrics():
+    stats = db_stats()
+    stats["tarefas"] = tarefas_stats()
+    return jsonify(stats)
+
 def run_flask():
     flask_app.run(host="0.0.0.0", port=10000)
 
 # ========== MAIN ==========
 def main():
+    DB_POOL.prefill()
     init_db()
     threading.Thread(target=run_flask, daemon=True).start()
-    threading.Thread(target=reset_diario_rerolls, daemon=True).start()
-    threading.Thread(target=cleanup_expired_transfers, daemon=True).start()
-    threading.Thread(target=thread_reset_xp, daemon=True).start()
-    app = Application.builder().token(TOKEN).build()
+    app = Application.builder().token(TOKEN).concurrent_updates(CONCURRENT_UPDATES).post_init(post_init).post_shutdown(post_shutdown).build()
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("ficha", ficha))
     app.add_handler(CommandHandler("verficha", verficha))
     app.add_handler(CommandHandler("inventario", inventario))
     app.add_handler(CommandHandler("itens", itens))
+    app.add_handler(CallbackQueryHandler(itens_callback, pattern=r'^itens_'))
+    app.add_handler(CallbackQueryHandler(sugestao_callback, pattern=r'^sug_'))
     app.add_handler(CommandHandler("additem", additem))
     app.add_handler(CommandHandler("addarma", addarma))
     app.add_handler(CommandHandler("addconsumivel", addconsumivel))